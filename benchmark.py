@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+   benchmark.py - Measure getmyancestors.py HTTP throughput against a local stand-in
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# global import
+from __future__ import print_function
+import os
+import sys
+import ssl
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# local import
+from getmyancestors import Session, RetryPolicy, CircuitBreaker, new_http_session, requests, POOL_CONNECTIONS, POOL_MAXSIZE
+
+
+# HTTPS server that counts the TLS handshakes it performs
+class CountingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, context):
+        super(CountingServer, self).__init__(address, handler)
+        self.context = context
+        self.handshakes = 0
+        self.lock = threading.Lock()
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        with self.lock:
+            self.handshakes += 1
+        return self.context.wrap_socket(sock, server_side=True), address
+
+
+# answer every GET with a small notes.json payload after a fixed latency, or with 502 during an outage
+class NotesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    outage = (0, 0)
+    body = json.dumps({'persons': [{'notes': [{'subject': 'subject', 'text': 'text'}]}]}).encode('utf-8')
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.outage[0] <= time.time() < self.outage[1]:
+            self.send_response(502)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Session without login, talking to the local server
+class LocalSession(Session):
+    def __init__(self, base, cert, legacy=False, **kwargs):
+        self.cert = cert
+        self.legacy = legacy
+        super(LocalSession, self).__init__('', '', base_url=base, **kwargs)
+
+    def login(self):
+        # REQUESTS_CA_BUNDLE would take precedence over the self-signed certificate
+        self.http.trust_env = False
+        self.http.verify = self.cert
+        self.fssessionid = 'benchmark'
+        return True
+
+    def breaker(self, url):
+        if self.legacy:
+            return CircuitBreaker(url, self, threshold=float('inf'))
+        return super(LocalSession, self).breaker(url)
+
+
+# sleep for the whole timeout after every failure, as getmyancestors.py used to
+class FixedPolicy(RetryPolicy):
+    def delay(self, attempt):
+        return self.cap
+
+
+# self-signed certificate for localhost
+def make_certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+                           '-keyout', key, '-out', cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+# issue n requests from a pool of workers, either one connection per request or through the pooled transport
+def crawl(server, url, cert, n, workers, pooled, pool_connections, pool_maxsize):
+    server.handshakes = 0
+    if pooled:
+        http = new_http_session(pool_connections, pool_maxsize)
+        get = http.get
+    else:
+        get = requests.get
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for r in executor.map(lambda i: get(url % i, verify=cert, timeout=60), range(n)):
+            r.json()
+    return server.handshakes, time.time() - start
+
+
+# keep workers busy through an outage: returns the seconds between the end of the outage and the first success
+def recovery(base, cert, outage, timeout, workers, legacy):
+    policy = FixedPolicy(cap=timeout, max_attempts=1000) if legacy else RetryPolicy(cap=timeout)
+    fs = LocalSession(base, cert, legacy, timeout=timeout, retry_policy=policy, pool_maxsize=workers)
+    start = time.time() + 1
+    NotesHandler.outage = (start, start + outage)
+    successes = list()
+
+    def worker(n):
+        i = 0
+        while not successes or successes[-1] < start + outage:
+            i += 1
+            if fs.get_url('/platform/tree/persons/P%s-%s/notes.json' % (n, i)):
+                successes.append(time.time())
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(worker, range(workers)))
+    NotesHandler.outage = (0, 0)
+    return successes[-1] - start - outage, fs.counter, fs.retries, fs.trips
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the getmyancestors.py HTTP transport', add_help=False, usage='benchmark.py [options]')
+    parser.add_argument('-n', metavar='<INT>', type=int, default=2000, help='Number of requests per crawl [2000]')
+    parser.add_argument('-w', metavar='<INT>', type=int, default=POOL_MAXSIZE, help='Number of download threads [%s]' % POOL_MAXSIZE)
+    parser.add_argument('--latency', metavar='<FLOAT>', type=float, default=0.005, help='Server latency in seconds [0.005]')
+    parser.add_argument('--pool-connections', metavar='<INT>', type=int, default=POOL_CONNECTIONS, help='Number of hosts to keep a connection pool for [%s]' % POOL_CONNECTIONS)
+    parser.add_argument('--pool-maxsize', metavar='<INT>', type=int, default=POOL_MAXSIZE, help='Number of keep-alive connections per host [%s]' % POOL_MAXSIZE)
+    parser.add_argument('--outage', metavar='<FLOAT>', type=float, default=0, help='Also measure the recovery after an outage of that many seconds [0]')
+    parser.add_argument('-t', metavar='<INT>', type=int, default=60, help='Timeout in seconds, slept after each failure before retry policies [60]')
+    parser.add_argument('-o', metavar='<FILE>', type=argparse.FileType('w', encoding='UTF-8'), default=sys.stdout, help='output JSON results [stdout]')
+
+    try:
+        parser.error = parser.exit
+        args = parser.parse_args()
+    except SystemExit:
+        parser.print_help()
+        exit(2)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cert, key = make_certificate(tmp_dir)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        NotesHandler.latency = args.latency
+        server = CountingServer(('localhost', 0), NotesHandler, context)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'https://localhost:%s/platform/tree/persons/P%%s/notes.json' % server.server_address[1]
+
+        results = dict()
+        for name, pooled in (('per-request', False), ('pooled', True)):
+            handshakes, seconds = crawl(server, url, cert, args.n, args.w, pooled, args.pool_connections, args.pool_maxsize)
+            results[name] = {'requests': args.n, 'handshakes': handshakes, 'seconds': round(seconds, 3)}
+            sys.stderr.write('%s: %s requests, %s handshakes in %s seconds\n' % (name, args.n, handshakes, round(seconds, 3)))
+        if args.outage:
+            base = 'https://localhost:%s' % server.server_address[1]
+            for name, legacy in (('fixed-sleep', True), ('backoff', False)):
+                seconds, counter, retries, trips = recovery(base, cert, args.outage, args.t, args.w, legacy)
+                results['recovery-' + name] = {'outage': args.outage, 'seconds': round(seconds, 3), 'requests': counter, 'retries': retries, 'trips': trips}
+                sys.stderr.write('%s: recovered %s seconds after a %s seconds outage (%s requests, %s retries, %s circuit breaker trips)\n' % (name, round(seconds, 3), args.outage, counter, retries, trips))
+        server.shutdown()
+
+    json.dump(results, args.o, indent=2)
+    args.o.write('\n')
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+   crawlbenchmark.py - Measure the whole getmyancestors.py crawl against fsstandin.py
+   and compare the results with a baseline
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# global import
+from __future__ import print_function
+import sys
+import json
+import math
+import time
+import queue
+import argparse
+import platform
+import resource
+import multiprocessing
+
+# local import
+from fsstandin import Pedigree, StandInServer
+
+# metrics compared with the baseline: larger is worse for all of them
+METRICS = ('wall', 'cpu', 'requests', 'peak_rss', 'output_bytes')
+
+
+# file-like object counting the bytes of the GEDCOM output
+class CountingFile:
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text.encode('utf-8'))
+
+
+# wall time, CPU time and HTTP requests of each phase of a crawl
+class Phases:
+    def __init__(self, fs):
+        self.fs = fs
+        self.results = dict()
+
+    def run(self, name, function, *args):
+        wall, cpu, counter = time.perf_counter(), time.process_time(), self.fs.counter
+        result = function(*args)
+        phase = self.results.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'requests': 0})
+        phase['wall'] += time.perf_counter() - wall
+        phase['cpu'] += time.process_time() - cpu
+        phase['requests'] += self.fs.counter - counter
+        return result
+
+
+# the getmyancestors.py pipeline, run in a child process so that its peak RSS is its own
+def crawl(base_url, ascend, descend, ordinances, contributors, max_rate, max_in_flight, per_generation, bulk, results):
+    from getmyancestors import Session, AsyncSession, Tree, aiohttp, LINGER
+
+    start = time.perf_counter()
+    fs = Session('benchmark', 'benchmark', max_rate=max_rate, base_url=base_url)
+    tree = Tree(fs, AsyncSession(fs, max_in_flight) if aiohttp else None)
+    # as getmyancestors.py, the details are downloaded alongside the crawl
+    tree.prefetch_details(ordinances, contributors)
+    phases = Phases(fs)
+    todo = [fs.get_userid()]
+    phases.run('add_indis', tree.add_indis, todo)
+
+    if per_generation:
+        todo = set(todo)
+        done = set()
+        for i in range(ascend):
+            if not todo:
+                break
+            done |= todo
+            todo = phases.run('add_parents', tree.add_parents, todo) - done
+
+        todo = set(tree.indi.keys())
+        done = set()
+        for i in range(descend):
+            if not todo:
+                break
+            done |= todo
+            todo = phases.run('add_children', tree.add_children, todo) - done
+    else:
+        phases.run('crawl', tree.crawl, todo, ascend, descend, LINGER, bulk)
+
+    phases.run('add_spouses', tree.add_spouses, set(tree.indi.keys()))
+    phases.run('download_stuff', tree.download_stuff, ordinances, contributors)
+    tree.close()
+    phases.run('reset_num', tree.reset_num)
+    output = CountingFile()
+    phases.run('print', tree.print, output)
+
+    results.put({
+        'individuals': len(tree.indi),
+        'families': len(tree.fam),
+        'sources': len(tree.sources),
+        'notes': len(tree.notes),
+        'requests': fs.counter,
+        'retries': fs.retries,
+        'failures': fs.failures,
+        'wall': time.perf_counter() - start,
+        'cpu': time.process_time(),
+        # kilobytes on Linux, bytes on macOS
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        'output_bytes': output.bytes,
+        'phases': phases.results,
+        'endpoints': fs.metrics.to_json(),
+    })
+
+
+# serve a synthetic tree of that size and crawl it, keeping the fastest of several runs
+def benchmark(size, args):
+    depth = args.depth or max(1, int(math.log2(size)) - 1)
+    server = StandInServer(('localhost', 0), Pedigree(size, depth, args.branching, args.collapse, args.seed, args.payload), args.latency, args.latency_dist).start()
+    best = None
+    context = multiprocessing.get_context('spawn')
+    for i in range(args.repeat):
+        results = context.Queue()
+        process = context.Process(target=crawl, args=(server.base_url, depth, args.d, args.c, args.r, args.max_rate, args.max_in_flight, args.per_generation, args.bulk, results))
+        process.start()
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                # the crawl stopped without a result
+                if not process.is_alive() and results.empty():
+                    server.shutdown()
+                    server.server_close()
+                    exit('The crawl of %s persons failed with exit code %s' % (size, process.exitcode))
+        process.join()
+        if not best or result['wall'] < best['wall']:
+            best = result
+    best['server'] = server.stats()
+    server.shutdown()
+    server.server_close()
+    best['size'] = size
+    best['depth'] = depth
+    return best
+
+
+# metrics that got worse than the baseline by more than the threshold
+def regressions(results, baseline, threshold):
+    res = list()
+    for size, run in results['runs'].items():
+        if size not in baseline.get('runs', {}):
+            continue
+        old = baseline['runs'][size]
+        for metric in METRICS:
+            if metric in old and old[metric] and run[metric] > old[metric] * (1 + threshold):
+                res.append((size, metric, old[metric], run[metric]))
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the getmyancestors.py crawl against fsstandin.py', add_help=False, usage='crawlbenchmark.py [options]')
+    parser.add_argument('--sizes', metavar='<INT>', nargs='+', type=int, default=[100, 1000, 10000], help='Numbers of persons of the synthetic trees [100 1000 10000]')
+    parser.add_argument('--depth', metavar='<INT>', type=int, help='Generations of ancestors, also crawled with -a [log2(size) - 1]')
+    parser.add_argument('-d', metavar='<INT>', type=int, default=2, help='Number of generations to descend [2]')
+    parser.add_argument('-c', action="store_true", default=False, help='Add LDS ordinances [False]')
+    parser.add_argument('-r', action="store_true", default=False, help='Add list of contributors in notes [False]')
+    parser.add_argument('--branching', metavar='<INT>', type=int, default=3, help='Number of children per couple [3]')
+    parser.add_argument('--collapse', metavar='<FLOAT>', type=float, default=0.0, help='Pedigree collapse probability [0.0]')
+    parser.add_argument('--seed', metavar='<INT>', type=int, default=0, help='Random seed of the trees [0]')
+    parser.add_argument('--payload', metavar='<INT>', type=int, default=0, help='Bytes of padding added to each person [0]')
+    parser.add_argument('--latency', metavar='<FLOAT>', type=float, default=0.0, help='Mean latency of the stand-in in seconds [0.0]')
+    parser.add_argument('--latency-dist', metavar='<STR>', type=str, default='fixed', help='Distribution of the latency [fixed]')
+    parser.add_argument('--max-rate', metavar='<FLOAT>', type=float, default=10000, help='Maximum number of requests per second of the crawl [10000]')
+    parser.add_argument('--max-in-flight', metavar='<INT>', type=int, default=100, help='Maximum number of concurrent requests when aiohttp is installed [100]')
+    parser.add_argument('--per-generation', action="store_true", default=False, help='Crawl one generation at a time with add_parents and add_children, as before the frontier crawler [False]')
+    parser.add_argument('--bulk', action="store_true", default=False, help='Discover several generations per request with the ancestry and descendancy endpoints [False]')
+    parser.add_argument('--repeat', metavar='<INT>', type=int, default=1, help='Runs per size, the fastest is kept [1]')
+    parser.add_argument('--baseline', metavar='<FILE>', type=argparse.FileType('r', encoding='UTF-8'), help='Results of a previous run to compare with')
+    parser.add_argument('--threshold', metavar='<FLOAT>', type=float, default=0.1, help='Relative increase of a metric over the baseline reported as a regression [0.1]')
+    parser.add_argument('-o', metavar='<FILE>', type=argparse.FileType('w', encoding='UTF-8'), default=sys.stdout, help='output JSON results [stdout]')
+
+    try:
+        parser.error = parser.exit
+        args = parser.parse_args()
+    except SystemExit:
+        parser.print_help()
+        exit(2)
+
+    results = {'python': platform.python_version(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'settings': {k: v for k, v in vars(args).items() if k not in ('baseline', 'o')}, 'runs': dict()}
+    for size in args.sizes:
+        run = results['runs'][str(size)] = benchmark(size, args)
+        sys.stderr.write('%s persons: %s individuals and %s families in %.2f seconds (%.2f CPU) with %s HTTP requests, %.1f MB peak RSS, %s bytes of GEDCOM\n'
+                         % (size, run['individuals'], run['families'], run['wall'], run['cpu'], run['requests'], run['peak_rss'] / 1024 / 1024, run['output_bytes']))
+        for name, phase in run['phases'].items():
+            sys.stderr.write('    %-15s %8.2f s %8.2f s CPU %8s requests\n' % (name, phase['wall'], phase['cpu'], phase['requests']))
+
+    json.dump(results, args.o, indent=2)
+    args.o.write('\n')
+
+    if args.baseline:
+        found = regressions(results, json.load(args.baseline), args.threshold)
+        for size, metric, old, new in found:
+            sys.stderr.write('REGRESSION: %s persons, %s went from %s to %s\n' % (size, metric, round(old, 3), round(new, 3)))
+        if found:
+            exit(1)
+        sys.stderr.write('No regression over %s%% compared to the baseline\n' % round(args.threshold * 100))
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+   exportserver.py - Long-running export service: GEDCOM exports of FamilySearch trees
+   submitted through a local HTTP/JSON API and run by a pool of workers sharing one session
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# global import
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import queue
+import getpass
+import argparse
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+# local import
+from getmyancestors import Session, AsyncSession, Tree, ResponseCache, PersonCache, RetryPolicy, aiohttp, cache_dir, \
+    POOL_CONNECTIONS, POOL_MAXSIZE, MAX_RATE, MAX_ATTEMPTS, MAX_IN_FLIGHT, CACHE_TTL, CACHE_SIZE
+
+# options of a job, with their defaults as in getmyancestors.py
+JOB_OPTIONS = {'a': 4, 'd': 0, 'm': False, 'r': False, 'c': False}
+FINISHED = ('done', 'failed', 'cancelled')
+
+
+# export job: its options, its progress and, once done, the numbers of its tree and its GEDCOM file
+class Job:
+    def __init__(self, number, fids, options):
+        self.id = str(number)
+        self.fids = fids
+        self.options = options
+        self.status = 'queued'
+        self.phase = None
+        self.error = None
+        # tree of the job while it runs, then only its numbers of individuals, families, sources and notes
+        self.tree = None
+        self.counts = None
+        self.path = None
+        self.submitted = time.time()
+        self.started = self.finished = None
+        # notified on every change of status or phase
+        self.changed = threading.Condition()
+
+    def update(self, **kwargs):
+        with self.changed:
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+            self.changed.notify_all()
+
+    # wait for the next change, at most timeout seconds
+    def wait(self, timeout):
+        with self.changed:
+            self.changed.wait(timeout)
+
+    def to_json(self):
+        with self.changed:
+            res = {'id': self.id, 'i': self.fids, 'options': self.options, 'status': self.status, 'phase': self.phase, 'error': self.error,
+                   'submitted': self.submitted, 'started': self.started, 'finished': self.finished}
+            res.update(counts(self.tree) if self.tree else self.counts or dict())
+        return res
+
+
+# numbers of individuals, families, sources and notes of a tree
+def counts(tree):
+    return {'individuals': len(tree.indi), 'families': len(tree.fam), 'sources': len(tree.sources), 'notes': len(tree.notes)}
+
+
+# queue of the jobs, run by a pool of worker threads sharing one FamilySearch session and its caches
+class ExportService:
+    def __init__(self, fs, output_dir, workers=2, max_in_flight=MAX_IN_FLIGHT, persons=None, keep=100):
+        self.fs = fs
+        self.output_dir = output_dir
+        self.max_in_flight = max_in_flight
+        self.persons = persons
+        self.keep = keep
+        os.makedirs(output_dir, exist_ok=True)
+        self.jobs = dict()
+        self.counter = 0
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # the LDS check may take minutes of retries: only the jobs that need it wait for it
+        self.lds_lock = threading.Lock()
+        self.lds = None
+        self.workers = [threading.Thread(target=self.work, daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, fids, options):
+        with self.lock:
+            self.counter += 1
+            job = self.jobs[str(self.counter)] = Job(self.counter, fids, options)
+        self.queue.put(job)
+        return job
+
+    # forget a queued or finished job: returns False for a running one
+    def remove(self, job):
+        with self.lock:
+            if job.status == 'running':
+                return False
+            self.jobs.pop(job.id, None)
+            if job.status == 'queued':
+                job.update(status='cancelled', finished=time.time())
+        self.remove_file(job)
+        return True
+
+    def remove_file(self, job):
+        if job.path and os.path.exists(job.path):
+            os.remove(job.path)
+
+    # the LDS account is checked once, by the first job asking for ordinances
+    def lds_account(self):
+        with self.lds_lock:
+            if self.lds is None:
+                self.lds = self.fs.get_url('/platform/tree/persons/%s/ordinances.json' % self.fs.get_userid()) != 'error'
+            return self.lds
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            # a job cancelled meanwhile is not run
+            with self.lock:
+                start = job.status == 'queued'
+                if start:
+                    job.update(status='running', started=time.time())
+            if start:
+                try:
+                    self.export(job)
+                except Exception as e:
+                    self.fs.write_log('Job %s failed: %r' % (job.id, e))
+                    job.update(status='failed', phase=None, error=str(e) or repr(e), finished=time.time())
+                self.forget_old()
+            self.queue.task_done()
+
+    # the same phases as getmyancestors.py, on a tree of the job
+    def export(self, job):
+        options = job.options
+        if options['c'] and not self.lds_account():
+            return job.update(status='failed', error='LDS ordinances need an LDS account', finished=time.time())
+        tree = Tree(self.fs, AsyncSession(self.fs, self.max_in_flight) if aiohttp else None, self.persons)
+        try:
+            job.update(tree=tree, phase='starting individuals')
+            tree.prefetch_details(options['c'], options['r'])
+            tree.add_indis(job.fids)
+            job.update(phase='ancestors and descendants')
+            tree.crawl(job.fids, options['a'], options['d'])
+            if options['m']:
+                job.update(phase='spouses')
+                tree.add_spouses(set(tree.indi.keys()))
+            job.update(phase='notes' + (', ordinances' if options['c'] else '') + (' and contributors' if options['r'] else ''))
+            tree.download_stuff(options['c'], options['r'])
+        finally:
+            tree.close()
+            # the finished jobs do not hold their tree
+            job.update(counts=counts(tree), tree=None)
+        tree.reset_num()
+        path = os.path.join(self.output_dir, job.id + '.ged')
+        with open(path, 'w', encoding='UTF-8') as file:
+            tree.print(file)
+        job.update(status='done', phase=None, path=path, finished=time.time())
+
+    # drop the oldest finished jobs beyond the number to keep
+    def forget_old(self):
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.status in FINISHED), key=lambda job: job.finished)
+            for job in finished[:max(0, len(finished) - self.keep)]:
+                del self.jobs[job.id]
+                self.remove_file(job)
+
+    def stats(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        res = {status: sum(1 for job in jobs if job.status == status) for status in ('queued', 'running') + FINISHED}
+        res.update({'workers': len(self.workers), 'requests': self.fs.counter, 'retries': self.fs.retries, 'failures': self.fs.failures, 'coalesced': self.fs.coalesced})
+        if self.fs.cache:
+            res['cache_hits'] = self.fs.cache.hits
+        if self.persons:
+            res['person_cache_hits'] = self.persons.hits
+        return res
+
+
+# answer the API requests:
+#   POST /jobs                {"i": [IDs], "a": 4, "d": 0, "m": false, "r": false, "c": false}, returns the job
+#   GET /jobs                 all the jobs
+#   GET /jobs/<id>            the job, with its status, its phase and the numbers of individuals, families, sources and notes
+#   GET /jobs/<id>/progress   the job again on every change until it is finished, one JSON object per line
+#   GET /jobs/<id>/gedcom     the GEDCOM file of a finished job
+#   DELETE /jobs/<id>         cancel a queued job or forget a finished one
+#   GET /stats                numbers of jobs by status and HTTP statistics of the session
+class ExportHandler(BaseHTTPRequestHandler):
+
+    def send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200, headers=None):
+        self.send(status, json.dumps(data).encode('utf-8'), headers=headers)
+
+    def send_error_json(self, status, message):
+        self.send_json({'error': message}, status)
+
+    # the job of a /jobs/<id> path, None after an error response
+    def job(self, path):
+        job = self.server.service.jobs.get(path.split('/')[2])
+        if not job:
+            self.send_error_json(404, 'No such job')
+        return job
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.rstrip('/')
+        if path == '/jobs':
+            with self.server.service.lock:
+                jobs = list(self.server.service.jobs.values())
+            return self.send_json([job.to_json() for job in jobs])
+        if path == '/stats':
+            return self.send_json(self.server.service.stats())
+        match = re.fullmatch(r'/jobs/\w+(/progress|/gedcom)?', path)
+        if not match:
+            return self.send_error_json(404, 'Not found')
+        job = self.job(path)
+        if not job:
+            return
+        if match.group(1) == '/progress':
+            return self.progress(job)
+        if match.group(1) == '/gedcom':
+            if job.status != 'done':
+                return self.send_error_json(409, 'The job is %s' % job.status)
+            try:
+                with open(job.path, 'rb') as file:
+                    gedcom = file.read()
+            except OSError:
+                return self.send_error_json(410, 'The GEDCOM file of the job was removed')
+            return self.send(200, gedcom, 'text/plain; charset=utf-8', {'Content-Disposition': 'attachment; filename="%s.ged"' % job.id})
+        self.send_json(job.to_json())
+
+    # stream the state of the job until it is finished, at least every second while it runs
+    def progress(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        last = None
+        try:
+            while True:
+                state = job.to_json()
+                if state != last:
+                    self.wfile.write(json.dumps(state).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+                    last = state
+                if state['status'] in FINISHED:
+                    break
+                job.wait(1)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip('/') != '/jobs':
+            return self.send_error_json(404, 'Not found')
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        except ValueError:
+            return self.send_error_json(400, 'The body is not JSON')
+        if not isinstance(data, dict):
+            return self.send_error_json(400, 'The body is not a JSON object')
+        fids = data.get('i') or [self.server.service.fs.get_userid()]
+        if isinstance(fids, str):
+            fids = [fids]
+        for fid in fids:
+            if not isinstance(fid, str) or not re.fullmatch(r'[A-Z0-9]{4}-[A-Z0-9]{3}', fid):
+                return self.send_error_json(400, 'Invalid FamilySearch ID: %s' % fid)
+        options = dict()
+        for key, default in JOB_OPTIONS.items():
+            value = data.get(key, default)
+            if type(value) is not type(default) or isinstance(value, int) and value < 0:
+                return self.send_error_json(400, 'Invalid value of %s: %s' % (key, json.dumps(value)))
+            options[key] = value
+        job = self.server.service.submit(fids, options)
+        self.send_json(job.to_json(), 201, {'Location': '/jobs/' + job.id})
+
+    def do_DELETE(self):
+        path = urlsplit(self.path).path.rstrip('/')
+        if not re.fullmatch(r'/jobs/\w+', path):
+            return self.send_error_json(404, 'Not found')
+        job = self.job(path)
+        if not job:
+            return
+        if not self.server.service.remove(job):
+            return self.send_error_json(409, 'The job is running')
+        self.send_json(job.to_json())
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write('[%s]: %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), format % args))
+
+
+# threaded HTTP server of the API
+class ExportServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        super(ExportServer, self).__init__(address, ExportHandler)
+        self.service = service
+        self.verbose = verbose
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export FamilySearch trees to GEDCOM on request, through a local HTTP/JSON API', add_help=False, usage='exportserver.py -u username -p password [options]')
+    parser.add_argument('-u', metavar='<STR>', type=str, help='FamilySearch username')
+    parser.add_argument('-p', metavar='<STR>', type=str, help='FamilySearch password')
+    parser.add_argument('--host', metavar='<STR>', type=str, default='localhost', help='Address to listen on [localhost]')
+    parser.add_argument('--port', metavar='<INT>', type=int, default=8070, help='Port to listen on [8070]')
+    parser.add_argument('--workers', metavar='<INT>', type=int, default=2, help='Number of jobs run at the same time [2]')
+    parser.add_argument('--keep', metavar='<INT>', type=int, default=100, help='Number of finished jobs kept with their GEDCOM file [100]')
+    parser.add_argument('--output-dir', metavar='<DIR>', type=str, help='Directory of the GEDCOM files of the jobs [~/.cache/getmyancestors/exports]')
+    parser.add_argument("-v", action="store_true", default=False, help="Increase output verbosity [False]")
+    parser.add_argument('-t', metavar='<INT>', type=int, default=60, help='Timeout in seconds [60]')
+    parser.add_argument('--pool-connections', metavar='<INT>', type=int, default=POOL_CONNECTIONS, help='Number of hosts to keep a connection pool for [%s]' % POOL_CONNECTIONS)
+    parser.add_argument('--pool-maxsize', metavar='<INT>', type=int, default=POOL_MAXSIZE, help='Number of keep-alive connections per host and of download threads [%s]' % POOL_MAXSIZE)
+    parser.add_argument('--max-rate', metavar='<FLOAT>', type=float, default=MAX_RATE, help='Maximum number of requests per second of all the jobs, the actual rate adapts to the server [no limit]')
+    parser.add_argument('--max-attempts', metavar='<INT>', type=int, default=MAX_ATTEMPTS, help='Maximum number of attempts per URL [%s]' % MAX_ATTEMPTS)
+    parser.add_argument('--max-in-flight', metavar='<INT>', type=int, default=MAX_IN_FLIGHT, help='Maximum number of concurrent requests of a job when aiohttp is installed [%s]' % MAX_IN_FLIGHT)
+    parser.add_argument('--cache', action="store_true", default=False, help='Also keep the responses in a persistent cache, revalidated after --cache-ttl [False]')
+    parser.add_argument('--cache-dir', metavar='<DIR>', type=str, help='Cache directory [~/.cache/getmyancestors]')
+    parser.add_argument('--cache-ttl', metavar='<INT>', type=int, default=CACHE_TTL, help='Seconds during which cached data is used without revalidation [%s]' % CACHE_TTL)
+    parser.add_argument('--cache-size', metavar='<INT>', type=int, default=CACHE_SIZE, help='Maximum size of the cache in megabytes [%s]' % CACHE_SIZE)
+    parser.add_argument('--person-ttl', metavar='<INT>', type=int, default=3600, help='Seconds during which the persons downloaded by a job are used by the next jobs [3600]')
+    parser.add_argument('--base-url', metavar='<URL>', type=str, help='Base URL of the FamilySearch API, e.g. a local fsstandin.py server [https://familysearch.org]')
+    parser.add_argument('-l', metavar='<FILE>', type=argparse.FileType('w', encoding='UTF-8'), default=sys.stderr, help='output log file [stderr]')
+
+    try:
+        parser.error = parser.exit
+        args = parser.parse_args()
+    except SystemExit:
+        parser.print_help()
+        exit(2)
+
+    username = args.u if args.u else input("Enter FamilySearch username: ")
+    password = args.p if args.p else getpass.getpass("Enter FamilySearch password: ")
+
+    cache = ResponseCache(args.cache_dir, args.cache_ttl, args.cache_size) if args.cache else None
+    print('Login to FamilySearch...', file=sys.stderr)
+    fs = Session(username, password, args.v, args.l, args.t, args.pool_connections, args.pool_maxsize, args.max_rate, RetryPolicy(cap=args.t, max_attempts=args.max_attempts), cache, base_url=args.base_url)
+    if not fs.logged:
+        exit(2)
+    service = ExportService(fs, args.output_dir or os.path.join(cache_dir(args.cache_dir), 'exports'), args.workers, args.max_in_flight, PersonCache(args.cache_dir, args.person_ttl), args.keep)
+    server = ExportServer((args.host, args.port), service, args.v)
+    sys.stderr.write('Serving the export API at http://%s:%s/jobs with %s workers\n' % (args.host, server.server_address[1], args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+   fsstandin.py - Local stand-in for the FamilySearch API used by getmyancestors.py
+   serving a synthetic family tree, with configurable latency and faults
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# global import
+from __future__ import print_function
+import re
+import sys
+import ssl
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque, Counter
+from http.cookies import SimpleCookie
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+ID_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+# separate ranges of identifiers for persons, couples, child and parents relationships and sources
+PERSON_IDS = 36 ** 6
+COUPLE_IDS = 10 * 36 ** 6
+CAP_IDS = 20 * 36 ** 6
+SOURCE_IDS = 30 * 36 ** 6
+
+GIVEN_NAMES = {
+    'Male': ['John', 'William', 'James', 'Peter', 'Thomas', 'Jean', 'Pierre', 'Louis', 'Johann', 'Carl', 'Henry', 'Joseph'],
+    'Female': ['Mary', 'Elizabeth', 'Anne', 'Sarah', 'Margaret', 'Marie', 'Jeanne', 'Louise', 'Anna', 'Catherine', 'Emma', 'Alice'],
+}
+SURNAMES = ['Smith', 'Martin', 'Miller', 'Bernard', 'Taylor', 'Dubois', 'Schmidt', 'Brown', 'Moreau', 'Wilson', 'Fischer', 'Laurent', 'Clark', 'Weber', 'Young', 'Petit']
+TOWNS = ['Springfield', 'Riverside', 'Fairview', 'Kingston', 'Lyon', 'Rouen', 'Bremen', 'Kassel', 'Salem', 'Bristol', 'Dover', 'Chester']
+CONTRIBUTORS = ['FamilySearch', 'jdoe1954', 'mmartin', 'genealogist42', 'Family History Library', 'smith.family', 'lweber', 'kclark']
+TEMPLES = ['SLAKE', 'LOGAN', 'MANTI', 'SGEOR', 'LONDO', 'FRANK']
+LATENCY_DISTRIBUTIONS = ('fixed', 'uniform', 'exponential', 'lognormal')
+MAX_GENERATIONS = {'ancestry': 8, 'descendancy': 2}
+
+
+# FamilySearch-like identifier (XXXX-XXX) of a number
+def fsid(n):
+    s = ''
+    for i in range(7):
+        s = ID_CHARS[n % 36] + s
+        n //= 36
+    return s[:4] + '-' + s[4:]
+
+
+# synthetic family tree: ancestors of a root person up to a depth, then descendants of every couple, up to a size
+class Pedigree:
+    def __init__(self, size=1000, depth=8, branching=3, collapse=0.0, seed=0, payload=0):
+        self.size = size
+        self.depth = depth
+        self.branching = branching
+        self.collapse = collapse
+        self.seed = seed
+        self.payload = payload
+        self.rng = random.Random(seed)
+        self.persons = dict()
+        self.couples = dict()
+        self.caps = dict()
+        self.generations = dict()
+        self.places = [{'id': str(1000 + i), 'latitude': round(self.rng.uniform(-60, 70), 4), 'longitude': round(self.rng.uniform(-180, 180), 4), 'town': town}
+                       for i, town in enumerate(TOWNS)]
+        self.sources = max(1, size // 4)
+        self.root = self.new_person(0, 'Male', self.rng.choice(SURNAMES))['id']
+        ancestors = deque([self.root]) if depth > 0 else deque()
+        descendants = deque()
+        # ancestors first, breadth first, so that a small size still reaches the requested depth
+        while ancestors and len(self.persons) < size:
+            fid = ancestors.popleft()
+            couple = self.add_parents(fid)
+            if couple:
+                descendants.append(('children', couple['id']))
+                for parent in (couple['husband'], couple['wife']):
+                    if self.persons[parent]['generation'] < depth and not self.persons[parent]['parents']:
+                        ancestors.append(parent)
+        # then siblings, cousins and their descendants, with their spouses
+        while descendants and len(self.persons) < size:
+            task, key = descendants.popleft()
+            if task == 'children':
+                couple = self.couples[key]
+                while len(couple['children']) < branching and len(self.persons) < size:
+                    father = self.persons[couple['husband']]
+                    child = self.new_person(father['generation'] - 1, self.rng.choice(['Male', 'Female']), father['surname'])
+                    self.add_child(couple, child['id'])
+                    descendants.append(('spouse', child['id']))
+            elif task == 'spouse' and not self.persons[key]['couples'] and len(self.persons) < size:
+                person = self.persons[key]
+                spouse = self.new_person(person['generation'], 'Female' if person['gender'] == 'Male' else 'Male', self.rng.choice(SURNAMES))
+                couple = self.new_couple(key, spouse['id']) if person['gender'] == 'Male' else self.new_couple(spouse['id'], key)
+                descendants.append(('children', couple['id']))
+
+    def new_person(self, generation, gender, surname):
+        n = len(self.persons)
+        person = {
+            'id': fsid(PERSON_IDS + n),
+            'n': n,
+            'generation': generation,
+            'gender': gender,
+            'given': self.rng.choice(GIVEN_NAMES[gender]),
+            'surname': surname,
+            'birth': 1990 - 30 * generation + self.rng.randint(-5, 5),
+            'place': self.rng.choice(self.places)['id'],
+            'parents': None,
+            'couples': list(),
+        }
+        self.persons[person['id']] = person
+        return person
+
+    def new_couple(self, husband, wife):
+        n = len(self.couples)
+        couple = {'id': fsid(COUPLE_IDS + n), 'n': n, 'husband': husband, 'wife': wife, 'children': list()}
+        self.couples[couple['id']] = couple
+        self.persons[husband]['couples'].append(couple['id'])
+        self.persons[wife]['couples'].append(couple['id'])
+        generation = self.persons[husband]['generation']
+        self.generations.setdefault(generation, list()).append(couple['id'])
+        return couple
+
+    def add_child(self, couple, fid):
+        cap = fsid(CAP_IDS + len(self.caps))
+        self.caps[cap] = (couple['id'], fid)
+        couple['children'].append(fid)
+        self.persons[fid]['parents'] = cap
+
+    # give parents to a person, possibly an existing couple of the same generation (pedigree collapse)
+    def add_parents(self, fid):
+        person = self.persons[fid]
+        generation = person['generation'] + 1
+        if self.collapse and self.rng.random() < self.collapse:
+            candidates = [c for c in self.generations.get(generation, []) if len(self.couples[c]['children']) < self.branching]
+            if candidates:
+                couple = self.couples[self.rng.choice(candidates)]
+                self.add_child(couple, fid)
+                return None
+        if len(self.persons) + 2 > self.size:
+            return None
+        father = self.new_person(generation, 'Male', person['surname'] if person['gender'] == 'Male' or not person['parents'] else self.rng.choice(SURNAMES))
+        mother = self.new_person(generation, 'Female', self.rng.choice(SURNAMES))
+        couple = self.new_couple(father['id'], mother['id'])
+        self.add_child(couple, fid)
+        return couple
+
+    # deterministic random generator for the details of a person or couple
+    def details(self, n, salt):
+        return random.Random('%s-%s-%s' % (self.seed, salt, n))
+
+    def fact(self, typ, year, place, rng):
+        fact = {'type': typ, 'date': {'original': '%s %s %s' % (rng.randint(1, 28), rng.choice(['Jan', 'Mar', 'May', 'Jul', 'Sep', 'Nov']), year)},
+                'place': {'original': place['town'], 'description': '#' + place['id']}, 'attribution': {}}
+        if rng.random() < 0.2:
+            fact['attribution']['changeMessage'] = 'Corrected from the parish register'
+        return fact
+
+    def place(self, place_id):
+        return next(place for place in self.places if place['id'] == place_id)
+
+    def source_ids(self, n, salt):
+        rng = self.details(n, 'sources-' + salt)
+        if rng.random() < 0.3:
+            return []
+        # relatives are close in numbering, so they share records such as census pages
+        return sorted({fsid(SOURCE_IDS + (n // 4 + rng.randint(-2, 2)) % self.sources) for i in range(rng.randint(1, 3))})
+
+    def source_description(self, sid, base_url):
+        n = int(sid.replace('-', ''), 36) - SOURCE_IDS
+        rng = self.details(n, 'source')
+        source = {'id': sid, 'about': 'https://familysearch.org/ark:/61903/1:1:%s' % sid.replace('-', ''),
+                  'titles': [{'value': '%s census, %s, page %s' % (1850 + 10 * rng.randint(0, 15), rng.choice(TOWNS), rng.randint(1, 400))}],
+                  'citations': [{'value': '"%s Census," database, FamilySearch (%s/ark:/61903/1:1:%s)' % (rng.choice(TOWNS), base_url, sid.replace('-', ''))}]}
+        if rng.random() < 0.3:
+            source['notes'] = [{'text': 'Household of %s %s' % (rng.choice(GIVEN_NAMES['Male']), rng.choice(SURNAMES))}]
+        return source
+
+    # person in the format of persons.json
+    def person(self, fid):
+        p = self.persons[fid]
+        rng = self.details(p['n'], 'person')
+        place = self.place(p['place'])
+        name = {'preferred': True, 'type': 'http://gedcomx.org/BirthName', 'attribution': {},
+                'nameForms': [{'fullText': '%s %s' % (p['given'], p['surname']),
+                               'parts': [{'type': 'http://gedcomx.org/Given', 'value': p['given']}, {'type': 'http://gedcomx.org/Surname', 'value': p['surname']}]}]}
+        data = {'id': fid, 'names': [name], 'gender': {'type': 'http://gedcomx.org/' + p['gender']},
+                'facts': [self.fact('http://gedcomx.org/Birth', p['birth'], place, rng)]}
+        if p['birth'] < 1940:
+            data['facts'].append(self.fact('http://gedcomx.org/Death', p['birth'] + rng.randint(1, 90), place, rng))
+        if rng.random() < 0.1:
+            data['facts'].append({'type': 'http://familysearch.org/v1/LifeSketch', 'value': '%s was born in %s.' % (p['given'], place['town']), 'attribution': {}})
+        if rng.random() < 0.1:
+            data['names'].append({'preferred': False, 'type': 'http://gedcomx.org/Nickname', 'attribution': {},
+                                  'nameForms': [{'parts': [{'type': 'http://gedcomx.org/Given', 'value': p['given'][:3]}]}]})
+        if self.source_ids(p['n'], 'person'):
+            data['sources'] = self.person_source_references(fid)
+        if rng.random() < 0.2:
+            data['evidence'] = [{'id': 'memories'}]
+        if self.payload:
+            data['padding'] = 'x' * self.payload
+        return data
+
+    # persons.json of a list of persons, with their places and relationships
+    def persons_json(self, fids):
+        data = {'persons': list(), 'places': dict(), 'childAndParentsRelationships': dict(), 'relationships': dict()}
+        for fid in fids:
+            if fid not in self.persons:
+                continue
+            p = self.persons[fid]
+            person = self.person(fid)
+            data['persons'].append(person)
+            for fact in person['facts']:
+                if 'place' in fact:
+                    place = self.place(fact['place']['description'][1:])
+                    data['places'][place['id']] = {'id': place['id'], 'latitude': place['latitude'], 'longitude': place['longitude']}
+            caps = [p['parents']] if p['parents'] else []
+            for couple_id in p['couples']:
+                couple = self.couples[couple_id]
+                caps += [self.persons[child]['parents'] for child in couple['children']]
+                data['relationships'][couple_id] = {'id': couple_id, 'type': 'http://gedcomx.org/Couple',
+                                                    'person1': {'resourceId': couple['husband']}, 'person2': {'resourceId': couple['wife']}}
+            for cap in caps:
+                couple_id, child = self.caps[cap]
+                couple = self.couples[couple_id]
+                data['childAndParentsRelationships'][cap] = {'id': cap, 'father': {'resourceId': couple['husband']},
+                                                             'mother': {'resourceId': couple['wife']}, 'child': {'resourceId': child}}
+        if not data['persons']:
+            return None
+        for key in ('places', 'childAndParentsRelationships', 'relationships'):
+            data[key] = list(data[key].values())
+        return data
+
+    def display(self, fid, key, number):
+        p = self.persons[fid]
+        return {'id': fid, 'display': {'name': '%s %s' % (p['given'], p['surname']), 'gender': p['gender'], key: number}}
+
+    # ancestors of a person numbered by ahnentafel (father 2n, mother 2n + 1) up to some generations
+    def ancestry(self, fid, generations):
+        res = [self.display(fid, 'ascendancyNumber', '1')]
+        level = [(1, fid)]
+        for generation in range(generations):
+            parents = list()
+            for n, child in level:
+                if self.persons[child]['parents']:
+                    couple = self.couples[self.caps[self.persons[child]['parents']][0]]
+                    parents += [(2 * n, couple['husband']), (2 * n + 1, couple['wife'])]
+            res += [self.display(parent, 'ascendancyNumber', str(n)) for n, parent in parents]
+            level = parents
+        return {'persons': res}
+
+    # descendants of a person numbered as 1, 1-S (spouse), 1.1 (child), 1.1-S, 1.1.1... up to some generations
+    def descendancy(self, fid, generations):
+        res = list()
+        level = [('1', fid)]
+        for generation in range(generations + 1):
+            children = list()
+            for number, person in level:
+                res.append(self.display(person, 'descendancyNumber', number))
+                couples = self.persons[person]['couples']
+                for i, couple_id in enumerate(couples):
+                    couple = self.couples[couple_id]
+                    spouse = couple['wife'] if couple['husband'] == person else couple['husband']
+                    res.append(self.display(spouse, 'descendancyNumber', number + ('-S%s' % (i + 1) if len(couples) > 1 else '-S')))
+                    children += [(number, child) for child in couple['children']]
+            if generation < generations:
+                # children are numbered from 1 for each parent
+                counts = Counter()
+                level = list()
+                for number, child in children:
+                    counts[number] += 1
+                    level.append(('%s.%s' % (number, counts[number]), child))
+        return {'persons': res}
+
+    # source references of a person, as in persons.json and sources.json
+    def person_source_references(self, fid):
+        return [{'descriptionId': sid, 'attribution': {'changeMessage': 'Found in the census'} if i == 0 else {}} for i, sid in enumerate(self.source_ids(self.persons[fid]['n'], 'person'))]
+
+    def person_sources(self, fid, base_url):
+        return {'persons': [{'id': fid, 'sources': self.person_source_references(fid)}],
+                'sourceDescriptions': [self.source_description(sid, base_url) for sid in self.source_ids(self.persons[fid]['n'], 'person')]}
+
+    def notes(self, n, salt):
+        rng = self.details(n, 'notes-' + salt)
+        return [{'subject': 'Research note %s' % (i + 1), 'text': 'Checked the %s records.' % rng.choice(TOWNS)} for i in range(rng.choice([0, 0, 1, 2]))]
+
+    def person_memories(self, fid, base_url):
+        rng = self.details(self.persons[fid]['n'], 'memories')
+        memories = [{'mediaType': 'text/plain', 'titles': [{'value': 'Family story'}], 'descriptions': [{'value': 'Told by %s.' % rng.choice(GIVEN_NAMES['Female'])}]}]
+        for i in range(rng.randint(0, 2)):
+            url = '%s/platform/memories/memories/%s' % (base_url, 100000 + 10 * self.persons[fid]['n'] + i)
+            memories.append({'mediaType': 'image/jpeg', 'about': url, 'links': {'image': {'href': url}}, 'titles': [{'value': 'Photo %s' % (i + 1)}]})
+        return {'sourceDescriptions': memories}
+
+    # change history, newest first, with the times in milliseconds
+    def changes(self, n, salt, edited=None):
+        rng = self.details(n, 'changes-' + salt)
+        entries = [{'updated': 1000 * rng.randint(1262304000, 1577836800), 'contributors': [{'name': rng.choice(CONTRIBUTORS)}]} for i in range(rng.randint(1, 4))]
+        if edited:
+            entries.append({'updated': edited, 'contributors': [{'name': rng.choice(CONTRIBUTORS)}]})
+        return {'entries': sorted(entries, key=lambda entry: -entry['updated'])}
+
+    # edit a fraction of the persons (their given name) and of the couples (their marriage), recorded in their change history
+    def edit(self, fraction, when=None):
+        rng = random.Random('%s-edits-%s' % (self.seed, fraction))
+        when = int(1000 * (when or time.time()))
+        edited = 0
+        for p in self.persons.values():
+            if rng.random() < fraction:
+                p['given'] = rng.choice([name for name in GIVEN_NAMES[p['gender']] if name != p['given']])
+                p['edited'] = when
+                edited += 1
+        for c in self.couples.values():
+            if rng.random() < fraction:
+                c['edited'] = when
+                edited += 1
+        return edited
+
+    def ordinances(self, fid):
+        p = self.persons[fid]
+        rng = self.details(p['n'], 'ordinances')
+        ordinances = list()
+        for typ in ('Baptism', 'Confirmation', 'Endowment'):
+            if rng.random() < 0.6:
+                ordinances.append({'type': 'http://lds.org/' + typ, 'status': 'http://familysearch.org/v1/Completed',
+                                   'date': {'formal': '+%s-%02d-%02d' % (rng.randint(1960, 2020), rng.randint(1, 12), rng.randint(1, 28))}, 'templeCode': rng.choice(TEMPLES)})
+        if p['parents'] and rng.random() < 0.5:
+            couple = self.couples[self.caps[p['parents']][0]]
+            ordinances.append({'type': 'http://lds.org/SealingChildToParents', 'status': 'http://familysearch.org/v1/Completed', 'templeCode': rng.choice(TEMPLES),
+                               'father': {'resourceId': couple['husband']}, 'mother': {'resourceId': couple['wife']}})
+        for couple_id in p['couples']:
+            couple = self.couples[couple_id]
+            if rng.random() < 0.5:
+                ordinances.append({'type': 'http://lds.org/SealingToSpouse', 'status': 'http://familysearch.org/v1/Ready',
+                                   'spouse': {'resourceId': couple['wife'] if couple['husband'] == fid else couple['husband']}})
+        return {'persons': [{'id': fid, 'ordinances': ordinances}]}
+
+    def couple(self, couple_id):
+        c = self.couples[couple_id]
+        rng = self.details(c['n'], 'couple')
+        husband = self.persons[c['husband']]
+        relationship = {'id': couple_id, 'type': 'http://gedcomx.org/Couple', 'person1': {'resourceId': c['husband']}, 'person2': {'resourceId': c['wife']}}
+        if rng.random() < 0.7 or c.get('edited'):
+            relationship['facts'] = [self.fact('http://gedcomx.org/Marriage', husband['birth'] + rng.randint(18, 35), self.place(husband['place']), rng)]
+            if c.get('edited'):
+                relationship['facts'][0]['attribution']['changeMessage'] = 'Marriage date checked'
+        sids = self.source_ids(c['n'], 'couple')
+        if sids:
+            relationship['sources'] = [{'descriptionId': sid, 'attribution': {}} for sid in sids]
+        return relationship
+
+    def couple_sources(self, couple_id, base_url):
+        return {'relationships': [self.couple(couple_id)],
+                'sourceDescriptions': [self.source_description(sid, base_url) for sid in self.source_ids(self.couples[couple_id]['n'], 'couple')]}
+
+
+# answer the requests of getmyancestors.py from a Pedigree
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        (r'/platform/users/current\.json', 'current_user'),
+        (r'/platform/tree/persons\.json', 'persons'),
+        (r'/platform/tree/(ancestry|descendancy)', 'pedigree'),
+        (r'/platform/tree/persons/([A-Z0-9]{4}-[A-Z0-9]{3})\.json', 'person'),
+        (r'/platform/tree/persons/([A-Z0-9]{4}-[A-Z0-9]{3})/(sources|notes|memories|changes|ordinances)\.json', 'person_details'),
+        (r'/platform/tree/couple-relationships/([A-Z0-9]{4}-[A-Z0-9]{3})\.json', 'couple'),
+        (r'/platform/tree/couple-relationships/([A-Z0-9]{4}-[A-Z0-9]{3})/(sources|notes|changes)\.json', 'couple_details'),
+        (r'/platform/sources/descriptions/([A-Z0-9]{4}-[A-Z0-9]{3})\.json', 'source'),
+    ]
+
+    def base_url(self):
+        return '%s://%s' % ('https' if self.server.context else 'http', self.headers.get('Host', '%s:%s' % self.server.server_address[:2]))
+
+    def send(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(status, len(body))
+
+    def send_json(self, data):
+        if data is None:
+            return self.send(404)
+        body = json.dumps(data).encode('utf-8')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, headers={'ETag': etag})
+        self.send(200, body, headers={'ETag': etag})
+
+    def redirect(self, location, headers=None):
+        headers = dict(headers or {})
+        headers['Location'] = location
+        self.send(302, content_type='text/html', headers=headers)
+
+    def do_GET(self):
+        self.server.wait()
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/auth/familysearch/login':
+            self.redirect(self.base_url() + '/cis-web/oauth2/v3/authorization/login')
+        elif url.path == '/cis-web/oauth2/v3/authorization/login':
+            params = self.server.new_token('params')
+            self.send(200, ('<form method="post"><input type="hidden" name="params" value="%s"></form>' % params).encode('utf-8'), 'text/html')
+        elif url.path == '/auth/familysearch/callback':
+            code = query.get('code', [''])[0]
+            if not self.server.use_token('code', code):
+                return self.send(400, b'Invalid Oauth2 Request', 'text/html')
+            self.redirect(self.base_url() + '/', {'Set-Cookie': 'fssessionid=%s; Path=/' % self.server.new_token('session')})
+        elif url.path == '/stand-in/stats.json':
+            self.send(200, json.dumps(self.server.stats()).encode('utf-8'))
+        elif url.path.startswith('/platform/'):
+            self.platform(url.path, query)
+        else:
+            self.send(404)
+
+    def do_POST(self):
+        self.server.wait()
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if urlsplit(self.path).path != '/cis-web/oauth2/v3/authorization':
+            return self.send(404)
+        if not self.server.use_token('params', form.get('params', [''])[0]):
+            return self.send(200, b'Invalid Oauth2 Request', 'text/html')
+        if self.server.password is not None and form.get('password', [''])[0] != self.server.password:
+            return self.send(200, b'The username or password was incorrect', 'text/html')
+        self.redirect(self.base_url() + '/auth/familysearch/callback?code=' + self.server.new_token('code'))
+
+    def platform(self, path, query):
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        fssessionid = cookie['fssessionid'].value if 'fssessionid' in cookie else None
+        if not self.server.valid_session(fssessionid):
+            return self.send(401, json.dumps({'errors': [{'message': 'Unauthorized'}]}).encode('utf-8'))
+        fault = self.server.fault()
+        if fault == 401:
+            self.server.expire_session(fssessionid)
+            return self.send(401, json.dumps({'errors': [{'message': 'Unauthorized'}]}).encode('utf-8'))
+        if fault:
+            return self.send(fault, headers={'Retry-After': str(self.server.retry_after)} if fault in (429, 503) else None)
+        for pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if match:
+                return getattr(self, name)(query, *match.groups())
+        self.send(404)
+
+    def current_user(self, query):
+        self.send_json({'users': [{'personId': self.server.pedigree.root, 'preferredLanguage': 'en', 'displayName': 'Stand-in User'}]})
+
+    def persons(self, query):
+        if 'pids' not in query:
+            return self.send(400)
+        self.send_json(self.server.pedigree.persons_json(query['pids'][0].split(',')))
+
+    def pedigree(self, query, kind):
+        fid = query.get('person', [''])[0]
+        generations = query.get('generations', ['4' if kind == 'ancestry' else '2'])[0]
+        if not generations.isdigit() or not 1 <= int(generations) <= MAX_GENERATIONS[kind]:
+            return self.send(400, json.dumps({'errors': [{'message': 'generations must be between 1 and %s' % MAX_GENERATIONS[kind]}]}).encode('utf-8'))
+        if fid not in self.server.pedigree.persons:
+            return self.send(404)
+        self.send_json(getattr(self.server.pedigree, kind)(fid, int(generations)))
+
+    def person(self, query, fid):
+        self.send_json(self.server.pedigree.persons_json([fid]))
+
+    def person_details(self, query, fid, detail):
+        pedigree = self.server.pedigree
+        if fid not in pedigree.persons:
+            return self.send(404)
+        n = pedigree.persons[fid]['n']
+        if detail == 'sources':
+            self.send_json(pedigree.person_sources(fid, self.base_url()))
+        elif detail == 'notes':
+            self.send_json({'persons': [{'id': fid, 'notes': pedigree.notes(n, 'person')}]})
+        elif detail == 'memories':
+            self.send_json(pedigree.person_memories(fid, self.base_url()))
+        elif detail == 'changes':
+            self.send_json(pedigree.changes(n, 'person', pedigree.persons[fid].get('edited')))
+        elif not self.server.lds:
+            self.send(403, json.dumps({'errors': [{'message': 'Unable to get ordinances.'}]}).encode('utf-8'))
+        else:
+            self.send_json(pedigree.ordinances(fid))
+
+    def couple(self, query, couple_id):
+        pedigree = self.server.pedigree
+        self.send_json({'relationships': [pedigree.couple(couple_id)]} if couple_id in pedigree.couples else None)
+
+    def couple_details(self, query, couple_id, detail):
+        pedigree = self.server.pedigree
+        if couple_id not in pedigree.couples:
+            return self.send(404)
+        n = pedigree.couples[couple_id]['n']
+        if detail == 'sources':
+            self.send_json(pedigree.couple_sources(couple_id, self.base_url()))
+        elif detail == 'notes':
+            self.send_json({'relationships': [{'id': couple_id, 'notes': pedigree.notes(n, 'couple')}]})
+        else:
+            self.send_json(pedigree.changes(n, 'couple', pedigree.couples[couple_id].get('edited')))
+
+    def source(self, query, sid):
+        pedigree = self.server.pedigree
+        n = int(sid.replace('-', ''), 36) - SOURCE_IDS
+        self.send_json({'sourceDescriptions': [pedigree.source_description(sid, self.base_url())]} if 0 <= n < pedigree.sources else None)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write('[%s]: %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), format % args))
+
+
+# threaded HTTP(S) server holding the pedigree, the sessions, the faults to inject and the statistics
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pedigree, latency=0.0, distribution='fixed', faults=None, retry_after=1, session_ttl=0, password=None, lds=True, context=None, verbose=False):
+        super(StandInServer, self).__init__(address, StandInHandler)
+        self.pedigree = pedigree
+        self.latency = latency
+        self.distribution = distribution
+        self.faults = faults or dict()
+        self.retry_after = retry_after
+        self.session_ttl = session_ttl
+        self.password = password
+        self.lds = lds
+        self.context = context
+        self.verbose = verbose
+        if context:
+            # the handshake happens in the handler thread, on the first read
+            self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self.lock = threading.Lock()
+        self.rng = random.Random(pedigree.seed)
+        self.tokens = {'params': dict(), 'code': dict(), 'session': dict()}
+        self.connections = self.requests = self.bytes = 0
+        self.status = Counter()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return '%s://%s:%s' % ('https' if self.context else 'http', 'localhost' if host in ('127.0.0.1', '0.0.0.0') else host, port)
+
+    # serve in a background thread
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super(StandInServer, self).process_request(request, client_address)
+
+    def record(self, status, length):
+        with self.lock:
+            self.requests += 1
+            self.bytes += length
+            self.status[status] += 1
+
+    def stats(self):
+        with self.lock:
+            return {'persons': len(self.pedigree.persons), 'couples': len(self.pedigree.couples), 'connections': self.connections,
+                    'requests': self.requests, 'bytes': self.bytes, 'status': {str(k): v for k, v in sorted(self.status.items())}}
+
+    # sleep for a latency drawn from the configured distribution, around its mean
+    def wait(self):
+        if not self.latency:
+            return
+        with self.lock:
+            if self.distribution == 'uniform':
+                latency = self.rng.uniform(0, 2 * self.latency)
+            elif self.distribution == 'exponential':
+                latency = self.rng.expovariate(1 / self.latency)
+            elif self.distribution == 'lognormal':
+                latency = self.rng.lognormvariate(math.log(self.latency) - 0.125, 0.5)
+            else:
+                latency = self.latency
+        time.sleep(latency)
+
+    # status code of the fault to inject, if any
+    def fault(self):
+        with self.lock:
+            draw = self.rng.random()
+        for status, probability in sorted(self.faults.items()):
+            if draw < probability:
+                return status
+            draw -= probability
+        return None
+
+    def new_token(self, kind):
+        token = hashlib.sha1(('%s-%s' % (kind, self.rng.random())).encode('utf-8')).hexdigest()
+        with self.lock:
+            self.tokens[kind][token] = time.time()
+        return token
+
+    def use_token(self, kind, token):
+        with self.lock:
+            return self.tokens[kind].pop(token, None) is not None
+
+    def valid_session(self, fssessionid):
+        with self.lock:
+            created = self.tokens['session'].get(fssessionid)
+        return created is not None and not (self.session_ttl and time.time() - created > self.session_ttl)
+
+    def expire_session(self, fssessionid):
+        with self.lock:
+            self.tokens['session'].pop(fssessionid, None)
+
+
+# parse a CODE=PROBABILITY fault option
+def fault_option(value):
+    status, probability = value.split('=')
+    return int(status), float(probability)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic family tree through a local stand-in of the FamilySearch API', add_help=False, usage='fsstandin.py [options]')
+    parser.add_argument('--host', metavar='<STR>', type=str, default='localhost', help='Address to listen on [localhost]')
+    parser.add_argument('--port', metavar='<INT>', type=int, default=8080, help='Port to listen on, 0 for any free port [8080]')
+    parser.add_argument('--size', metavar='<INT>', type=int, default=1000, help='Number of persons in the tree [1000]')
+    parser.add_argument('--depth', metavar='<INT>', type=int, default=8, help='Number of generations of ancestors of the root person [8]')
+    parser.add_argument('--branching', metavar='<INT>', type=int, default=3, help='Number of children per couple [3]')
+    parser.add_argument('--collapse', metavar='<FLOAT>', type=float, default=0.0, help='Probability that an ancestor descends from an already known couple (pedigree collapse) [0.0]')
+    parser.add_argument('--seed', metavar='<INT>', type=int, default=0, help='Random seed of the tree, latencies and faults [0]')
+    parser.add_argument('--payload', metavar='<INT>', type=int, default=0, help='Bytes of padding added to each person [0]')
+    parser.add_argument('--edits', metavar='<FLOAT>', type=float, default=0.0, help='Fraction of the persons and couples edited when the stand-in starts, as shown by their change history [0.0]')
+    parser.add_argument('--latency', metavar='<FLOAT>', type=float, default=0.0, help='Mean latency of the responses in seconds [0.0]')
+    parser.add_argument('--latency-dist', metavar='<STR>', choices=LATENCY_DISTRIBUTIONS, default='fixed', help='Distribution of the latency: %s [fixed]' % ', '.join(LATENCY_DISTRIBUTIONS))
+    parser.add_argument('--fault', metavar='<CODE=FLOAT>', type=fault_option, action='append', default=[], help='Answer API requests with that status code at that probability, e.g. 429=0.05 or 401=0.001 (repeatable) []')
+    parser.add_argument('--retry-after', metavar='<INT>', type=int, default=1, help='Retry-After header of the 429 and 503 responses [1]')
+    parser.add_argument('--session-ttl', metavar='<INT>', type=int, default=0, help='Seconds before a session expires, 0 for never [0]')
+    parser.add_argument('--password', metavar='<STR>', type=str, help='Only accept this password [any]')
+    parser.add_argument('--no-lds', action="store_true", default=False, help='Refuse ordinances, as for a non-LDS account [False]')
+    parser.add_argument('--cert', metavar='<FILE>', type=str, help='Serve HTTPS with this certificate [HTTP]')
+    parser.add_argument('--key', metavar='<FILE>', type=str, help='Private key of the certificate')
+    parser.add_argument("-v", action="store_true", default=False, help="Log every request [False]")
+
+    try:
+        parser.error = parser.exit
+        args = parser.parse_args()
+    except SystemExit:
+        parser.print_help()
+        exit(2)
+
+    context = None
+    if args.cert:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(args.cert, args.key)
+    pedigree = Pedigree(args.size, args.depth, args.branching, args.collapse, args.seed, args.payload)
+    if args.edits:
+        sys.stderr.write('Edited %s persons and couples\n' % pedigree.edit(args.edits))
+    server = StandInServer((args.host, args.port), pedigree, args.latency, args.latency_dist, dict(args.fault), args.retry_after, args.session_ttl, args.password, not args.no_lds, context, args.v)
+    sys.stderr.write('Serving %s persons and %s couples at %s (root person %s)\n' % (len(pedigree.persons), len(pedigree.couples), server.base_url, pedigree.root))
+    sys.stderr.write('Run: getmyancestors.py -u user -p password --base-url %s\n' % server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
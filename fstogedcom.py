@@ -8,13 +8,12 @@ from threading import Thread
 from diskcache import Cache
 import time
 import tempfile
-import asyncio
 import re
 import os
 import sys
 
 # local import
-from getmyancestors import Session, Tree, Indi, Fam
+from getmyancestors import Session, AsyncSession, Tree, Indi, Fam, aiohttp
 from mergemyancestors import Gedcom
 from translation import translations
 
@@ -383,7 +382,7 @@ class Download(Frame):
             self.btn_valid.config(state='normal')
             self.info('')
             return
-        self.tree = Tree(self.fs)
+        self.tree = Tree(self.fs, AsyncSession(self.fs) if aiohttp else None)
         _ = self.fs._
         self.title.config(text=_('Options'))
         cache.delete('lang')
@@ -419,24 +418,14 @@ class Download(Frame):
         self.btn_valid.config(state='disabled')
         self.info(_('Downloading starting individuals...'))
         self.info_tree = True
+        # the notes, ordinances and contributors are downloaded alongside the crawl
+        self.tree.prefetch_details(self.options.ordinances.get(), self.options.contributors.get())
         self.tree.add_indis(todo)
-        todo = set(todo)
-        done = set()
-        for i in range(self.options.ancestors.get()):
-            if not todo:
-                break
-            done |= todo
-            self.info(_('Downloading %s. of generations of ancestors...') % (i + 1))
-            todo = self.tree.add_parents(todo) - done
-
-        todo = set(self.tree.indi.keys())
-        done = set()
-        for i in range(self.options.descendants.get()):
-            if not todo:
-                break
-            done |= todo
-            self.info(_('Downloading %s. of generations of descendants...') % (i + 1))
-            todo = self.tree.add_children(todo) - done
+        if self.options.ancestors.get():
+            self.info(_('Downloading %s generations of ancestors...') % self.options.ancestors.get())
+        if self.options.descendants.get():
+            self.info(_('Downloading %s generations of descendants...') % self.options.descendants.get())
+        self.tree.crawl(todo, self.options.ancestors.get(), self.options.descendants.get())
 
         if self.options.spouses.get():
             self.info(_('Downloading spouses and marriage information...'))
@@ -445,24 +434,9 @@ class Download(Frame):
         ordi = self.options.ordinances.get()
         cont = self.options.contributors.get()
 
-        async def download_stuff(loop):
-            futures = set()
-            for fid, indi in self.tree.indi.items():
-                futures.add(loop.run_in_executor(None, indi.get_notes))
-                if ordi:
-                    futures.add(loop.run_in_executor(None, self.tree.add_ordinances, fid))
-                if cont:
-                    futures.add(loop.run_in_executor(None, indi.get_contributors))
-            for fam in self.tree.fam.values():
-                futures.add(loop.run_in_executor(None, fam.get_notes))
-                if cont:
-                    futures.add(loop.run_in_executor(None, fam.get_contributors))
-            for future in futures:
-                await future
-
-        loop = asyncio.get_event_loop()
         self.info(_('Downloading notes') + (((',' if cont else _(' and')) + _(' ordinances')) if ordi else '') + (_(' and contributors') if cont else '') + '...')
-        loop.run_until_complete(download_stuff(loop))
+        self.tree.download_stuff(ordi, cont)
+        self.tree.close()
 
         self.tree.reset_num()
         self.btn_valid.config(command=self.save, state='normal', text=_('Save'))
@@ -29,6 +29,21 @@ import getpass
 import time
 import asyncio
 import re
+import io
+import copy
+import json
+import threading
+import random
+import os
+import zlib
+import pickle
+import sqlite3
+import email.utils
+import bisect
+import collections
+import heapq
+import signal
+from concurrent.futures import ThreadPoolExecutor
 
 # local import
 from translation import translations
@@ -47,8 +62,32 @@ except ImportError:
     sys.stderr.write('(run this in your terminal: "python3 -m pip install babelfish" or "python3 -m pip install --user babelfish")\n')
     exit(2)
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 MAX_PERSONS = 200  # is subject to change: see https://www.familysearch.org/developers/docs/api/tree/Persons_resource
 
+POOL_CONNECTIONS = 4  # familysearch.org, www.familysearch.org and ident.familysearch.org
+POOL_MAXSIZE = 16  # keep-alive connections per host, also the number of download threads
+MAX_IN_FLIGHT = 100  # concurrent requests of the asynchronous session
+MAX_BATCHES = 4  # concurrent persons.json batches, sent ahead of the other requests
+MAX_SOURCES = 16  # concurrent source description requests
+MAX_RATE = None  # requests per second the rate limiter may grow to, none: unlimited until the server throttles
+MAX_ATTEMPTS = 8  # attempts per URL before giving up
+BREAKER_THRESHOLD = 5  # consecutive failures on an endpoint before failing fast
+BREAKER_RESET = 5  # seconds between probes of an endpoint that failed
+BREAKER_WAIT = 300  # seconds a request waits for an endpoint that failed before giving up
+CACHE_TTL = 86400  # seconds a cached response is used without revalidation
+CACHE_SIZE = 1024  # megabytes of compressed responses kept in the cache
+BULK_GENERATIONS = {'ancestry': 8, 'descendancy': 2}  # generations per request of the ancestry and descendancy endpoints
+DETAIL_WORKERS = {'ordinances': 16, 'notes': 64, 'contributors': 16}  # concurrent downloads of each detail phase, by priority
+LINGER = 0.05  # seconds a partial persons.json batch of the crawl frontier waits for more IDs
+CHECKPOINT_INTERVAL = 60  # seconds between two checkpoints of the tree
+CHECKPOINT_VERSION = 1  # format of the checkpoints, those of another format are not resumed
+LATENCY_BUCKETS = [0.001 * 1.25 ** i for i in range(60)]  # upper bounds in seconds of the latency histograms, from 1 ms to 8 minutes
+
 FACT_TAGS = {
     'http://gedcomx.org/Birth': 'BIRT',
     'http://gedcomx.org/Christening': 'CHR',
@@ -111,17 +150,455 @@ def cont(string):
     return ('\n%s CONT ' % level).join(res)
 
 
+# pooled keep-alive HTTP transport, so that connections (and TLS handshakes) are reused between requests
+def new_http_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE):
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+
+# shared token bucket whose rate and window of concurrent requests follow additive-increase/multiplicative-decrease;
+# the rate starts at the maximum rate, and without one there is no token bucket until the server throttles
+class RateLimiter:
+    def __init__(self, max_rate=MAX_RATE, max_window=MAX_IN_FLIGHT, write_log=None):
+        self.max_rate = max_rate
+        self.max_window = max_window
+        self.write_log = write_log
+        self.rate = max_rate
+        self.window = 4.0
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.slow_start = True
+        self.latency = self.min_latency = None
+        self.last_update = self.last_decrease = time.time()
+        self.paused_until = self.urgent_until = 0
+        self.lock = threading.Lock()
+
+    # reserve a slot for a request: returns 0 when it may be sent, otherwise the number of seconds to wait before asking again;
+    # while an urgent request waits, the other requests are held back so that it gets the next slot
+    def reserve(self, urgent=False):
+        with self.lock:
+            now = time.time()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if not urgent and now < self.urgent_until:
+                return self.urgent_until - now
+            if self.in_flight >= int(self.window):
+                wait = min(1, (self.latency or 0.1) / self.window)
+            elif self.rate is None:
+                wait = 0
+            else:
+                self.tokens = min(self.window, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if wait:
+                if urgent:
+                    self.urgent_until = max(self.urgent_until, now + wait)
+                return wait
+            self.tokens -= 1
+            self.in_flight += 1
+            return 0
+
+    # release the slot of a request and adapt the rate to its outcome
+    def release(self, latency=None, status_code=None, retry_after=None):
+        with self.lock:
+            self.in_flight -= 1
+            if status_code in {429, 503}:
+                now = time.time()
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                # decrease at most once per round trip, as concurrent responses report the same congestion
+                if now - self.last_decrease > (self.latency or 0):
+                    self.last_decrease = now
+                    self.slow_start = False
+                    if self.rate is None:
+                        # the throughput that got throttled
+                        self.rate = self.window / (self.latency or 1)
+                        self.tokens = 0.0
+                        self.last_update = now
+                    self.rate = max(1.0, self.rate / 2)
+                    self.window = max(1.0, self.window / 2)
+                    self.log('throttled (%s)' % status_code)
+            elif latency is not None and status_code is not None and status_code < 500:
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+                if self.latency > 2 * self.min_latency + 0.05:
+                    # the server is slowing down, stop growing
+                    self.slow_start = False
+                    return
+                window = int(self.window)
+                increase = 1 if self.slow_start else 1 / self.window
+                if self.rate is not None:
+                    self.rate = self.rate + increase if self.max_rate is None else min(self.max_rate, self.rate + increase)
+                self.window = min(self.max_window, self.window + increase)
+                if int(self.window) != window:
+                    self.log('increased')
+
+    def log(self, reason):
+        if self.write_log:
+            rate = 'unlimited' if self.rate is None else '%.1f' % self.rate
+            self.write_log('Rate limiter %s: %s requests/s, window of %s requests' % (reason, rate, int(self.window)))
+
+
+# parse a Retry-After header, given either in seconds or as an HTTP date
+def retry_after_seconds(value):
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# capped exponential backoff with full jitter
+class RetryPolicy:
+    def __init__(self, base=0.5, cap=60, max_attempts=MAX_ATTEMPTS):
+        self.base = base
+        self.cap = cap
+        self.max_attempts = max_attempts
+
+    # seconds to wait after the given (1-based) failed attempt
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+# stop sending requests to an endpoint after consecutive failures, then let a single probe through every reset seconds
+class CircuitBreaker:
+    def __init__(self, name, fs, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET):
+        self.name = name
+        self.fs = fs
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.probed = 0
+        self.lock = threading.Lock()
+
+    # returns 0 when a request may be sent, otherwise the number of seconds until the next probe;
+    # a probe that never ended, e.g. cancelled, is replaced once it is older than the request timeout
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return 0
+            now = time.time()
+            if self.probing and now < self.probed + self.fs.timeout + self.reset:
+                return self.reset
+            wait = self.opened + self.reset - now
+            if wait <= 0:
+                self.probing = True
+                self.probed = now
+                return 0
+            return wait
+
+    def success(self):
+        with self.lock:
+            if self.opened is not None:
+                self.fs.write_log('Circuit closed for ' + self.name)
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.opened is None and self.failures >= self.threshold:
+                if self.opened is None:
+                    self.fs.trips += 1
+                    self.fs.write_log('WARNING: circuit open for ' + self.name)
+                self.opened = time.time()
+                self.probing = False
+
+
+# limits of a run on the number of individuals, the number of HTTP requests and the wall time (None for no limit):
+# checked before new work is started, so the requests in flight may go a little over them
+class Budget:
+    def __init__(self, persons=None, requests=None, seconds=None):
+        self.persons = persons
+        self.requests = requests
+        self.seconds = seconds
+        self.started = time.time()
+        # name of the first budget used up
+        self.reason = None
+
+    # name of the first budget used up by the tree, None if none is: no new individual is downloaded
+    def exceeded(self, tree):
+        if self.persons is not None and len(tree.indi) >= self.persons:
+            self.reason = self.reason or 'persons'
+            return 'persons'
+        return self.exhausted(tree)
+
+    # name of the request or time budget if it is used up: no new download is started at all
+    def exhausted(self, tree):
+        if self.requests is not None and tree.fs.counter >= self.requests:
+            self.reason = self.reason or 'requests'
+            return 'requests'
+        if self.seconds is not None and time.time() - self.started >= self.seconds:
+            self.reason = self.reason or 'time'
+            return 'time'
+        return None
+
+    # number of individuals that may still be added to the tree
+    def persons_left(self, tree):
+        return float('inf') if self.persons is None else self.persons - len(tree.indi)
+
+
+# endpoint template of a FamilySearch URL, e.g. /platform/tree/persons/%s/notes.json
+def endpoint(url):
+    return re.sub(r'/[A-Z0-9]{4}-[A-Z0-9]{3,4}(?=[/.])', '/%s', url.split('?')[0])
+
+
+# per-endpoint HTTP statistics: requests by status code, retries, failures, cache hits, bytes and latency histogram
+class Metrics:
+    def __init__(self):
+        self.endpoints = dict()
+        self.lock = threading.Lock()
+        self.dump_lock = threading.Lock()
+
+    def get(self, url):
+        key = endpoint(url)
+        if key not in self.endpoints:
+            self.endpoints[key] = {'requests': 0, 'status': dict(), 'retries': 0, 'failures': 0, 'cache_hits': 0, 'bytes': 0,
+                                   'latency_sum': 0.0, 'latency_max': 0.0, 'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self.endpoints[key]
+
+    # record an HTTP attempt, status being the status code or 'error' when no response was received
+    def record(self, url, status, latency, size):
+        with self.lock:
+            m = self.get(url)
+            m['requests'] += 1
+            m['status'][str(status)] = m['status'].get(str(status), 0) + 1
+            m['bytes'] += size
+            m['latency_sum'] += latency
+            m['latency_max'] = max(m['latency_max'], latency)
+            m['latency_buckets'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def count(self, url, key):
+        with self.lock:
+            self.get(url)[key] += 1
+
+    # upper bound of the histogram bucket holding the q quantile of the latency
+    @staticmethod
+    def quantile(m, q):
+        rank = q * m['requests']
+        total = 0
+        for i, n in enumerate(m['latency_buckets']):
+            total += n
+            if n and total >= rank:
+                return min(LATENCY_BUCKETS[i], m['latency_max']) if i < len(LATENCY_BUCKETS) else m['latency_max']
+        return 0.0
+
+    def to_json(self):
+        res = dict()
+        with self.lock:
+            for key, m in sorted(self.endpoints.items()):
+                res[key] = {x: m[x] for x in ('requests', 'status', 'retries', 'failures', 'cache_hits', 'bytes')}
+                res[key]['latency'] = {'sum': round(m['latency_sum'], 6), 'max': round(m['latency_max'], 6),
+                                       'p50': round(self.quantile(m, 0.5), 6), 'p95': round(self.quantile(m, 0.95), 6), 'p99': round(self.quantile(m, 0.99), 6)}
+        return res
+
+    # Prometheus text exposition format
+    def to_prometheus(self):
+        lines = list()
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            for name, key, help_text in (('retries', 'retries', 'Retries'), ('failures', 'failures', 'Requests given up after the last attempt'),
+                                         ('cache_hits', 'cache_hits', 'Responses served from the cache'), ('response_bytes', 'bytes', 'Bytes received')):
+                lines += ['# HELP getmyancestors_%s_total %s by endpoint' % (name, help_text), '# TYPE getmyancestors_%s_total counter' % name]
+                lines += ['getmyancestors_%s_total{endpoint="%s"} %s' % (name, e, m[key]) for e, m in endpoints]
+            lines += ['# HELP getmyancestors_requests_total HTTP requests by endpoint and status code', '# TYPE getmyancestors_requests_total counter']
+            lines += ['getmyancestors_requests_total{endpoint="%s",status="%s"} %s' % (e, status, n) for e, m in endpoints for status, n in sorted(m['status'].items())]
+            lines += ['# HELP getmyancestors_request_duration_seconds HTTP request latency by endpoint', '# TYPE getmyancestors_request_duration_seconds histogram']
+            for e, m in endpoints:
+                total = 0
+                for bound, n in zip(LATENCY_BUCKETS + ['+Inf'], m['latency_buckets']):
+                    total += n
+                    lines.append('getmyancestors_request_duration_seconds_bucket{endpoint="%s",le="%s"} %s' % (e, bound if bound == '+Inf' else '%.6g' % bound, total))
+                lines.append('getmyancestors_request_duration_seconds_sum{endpoint="%s"} %s' % (e, m['latency_sum']))
+                lines.append('getmyancestors_request_duration_seconds_count{endpoint="%s"} %s' % (e, m['requests']))
+        return '\n'.join(lines) + '\n'
+
+    # write the metrics to a file, in Prometheus format if its name ends with .prom and in JSON otherwise
+    def dump(self, path):
+        with self.dump_lock:
+            text = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.to_json(), indent=2) + '\n'
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+
+
+# directory of the cache, ~/.cache/getmyancestors by default
+def cache_dir(path=None):
+    if not path:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'getmyancestors')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# open a SQLite database of the cache directory, shared between threads
+def open_cache_db(path, name):
+    path = cache_dir(path)
+    db = sqlite3.connect(os.path.join(path, name), check_same_thread=False, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+# entry of the response cache
+class CachedResponse:
+    def __init__(self, body, etag, last_modified, fresh):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh = fresh
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+    # headers of a request revalidating this entry
+    def conditional_headers(self):
+        headers = dict()
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+# persistent response cache keyed by URL, compressed in SQLite and evicted least recently used first
+class ResponseCache:
+    def __init__(self, path=None, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        self.ttl = ttl
+        # max_size is in megabytes, as --cache-size
+        self.max_size = max_size * 1024 * 1024
+        self.lock = threading.Lock()
+        self.db = open_cache_db(path, 'responses.sqlite')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, stored REAL, accessed REAL, size INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.hits = self.revalidations = 0
+        # responses stored before this time are revalidated whatever their age
+        self.since = 0
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT body, etag, last_modified, stored FROM responses WHERE url = ?', (url,)).fetchone()
+            if not row:
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE url = ?', (time.time(), url))
+        body, etag, last_modified, stored = row
+        return CachedResponse(zlib.decompress(body), etag, last_modified, time.time() - stored < self.ttl and stored >= self.since)
+
+    def put(self, url, body, etag=None, last_modified=None):
+        body = zlib.compress(body)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self.size += len(body) - (row[0] if row else 0)
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)', (url, body, etag, last_modified, now, now, len(body)))
+            while self.size > self.max_size:
+                rows = self.db.execute('SELECT url, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+                if not rows:
+                    break
+                self.db.executemany('DELETE FROM responses WHERE url = ?', ((row[0],) for row in rows))
+                self.size -= sum(row[1] for row in rows)
+
+    # the server confirmed that the cached response is still valid
+    def refresh(self, url):
+        with self.lock:
+            self.db.execute('UPDATE responses SET stored = ? WHERE url = ?', (time.time(), url))
+
+
+# persistent store of persons keyed by FamilySearch ID, with the places and relationships downloaded with them
+class PersonCache:
+    def __init__(self, path=None, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = open_cache_db(path, 'persons.sqlite')
+        self.db.execute('CREATE TABLE IF NOT EXISTS persons (fid TEXT PRIMARY KEY, data BLOB, expires REAL)')
+        self.hits = 0
+
+    # fresh persons among fids, merged in a persons.json structure keyed by FamilySearch ID
+    def get(self, fids):
+        fids = list(fids)
+        rows = list()
+        with self.lock:
+            for i in range(0, len(fids), 500):
+                chunk = fids[i:i + 500]
+                rows += self.db.execute('SELECT data FROM persons WHERE expires > ? AND fid IN (%s)' % ','.join('?' * len(chunk)), [time.time()] + chunk).fetchall()
+        data = {'persons': list(), 'places': dict(), 'childAndParentsRelationships': dict(), 'relationships': dict()}
+        for row in rows:
+            entry = json.loads(zlib.decompress(row[0]).decode('utf-8'))
+            data['persons'].append(entry['person'])
+            for key in ('places', 'childAndParentsRelationships', 'relationships'):
+                for x in entry[key]:
+                    data[key][x.get('id') or json.dumps(x, sort_keys=True)] = x
+        for key in ('places', 'childAndParentsRelationships', 'relationships'):
+            data[key] = list(data[key].values())
+        self.hits += len(data['persons'])
+        return data
+
+    # split a persons.json structure into one entry per person
+    def put(self, data, ttl=None):
+        places = {place['id']: place for place in data.get('places', [])}
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        rows = list()
+        for person in data['persons']:
+            fid = person['id']
+            entry = {
+                'person': person,
+                'places': [places[fact['place']['description'][1:]] for fact in person.get('facts', []) if 'description' in fact.get('place', {}) and fact['place']['description'][1:] in places],
+                'childAndParentsRelationships': [rel for rel in data.get('childAndParentsRelationships', []) if fid in (rel.get(x, {}).get('resourceId') for x in ('father', 'mother', 'child'))],
+                'relationships': [rel for rel in data.get('relationships', []) if fid in (rel['person1']['resourceId'], rel['person2']['resourceId'])],
+            }
+            rows.append((fid, zlib.compress(json.dumps(entry).encode('utf-8')), expires))
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO persons VALUES (?, ?, ?)', rows)
+
+    def remove(self, fids):
+        with self.lock:
+            self.db.executemany('DELETE FROM persons WHERE fid = ?', ((fid,) for fid in fids))
+
+
+# download shared by the concurrent callers of the same URL
+class InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
 # FamilySearch session class
 class Session:
-    def __init__(self, username, password, verbose=False, logfile=sys.stderr, timeout=60):
+    def __init__(self, username, password, verbose=False, logfile=sys.stderr, timeout=60, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_rate=MAX_RATE, retry_policy=None, cache=None, offline=False, session_file=None, base_url=None):
         self.username = username
         self.password = password
         self.verbose = verbose
         self.logfile = logfile
         self.timeout = timeout
-        self.fid = self.lang = self.display_name = None
-        self.counter = 0
-        self.logged = self.login()
+        self.pool_maxsize = pool_maxsize
+        self.http = new_http_session(pool_connections, pool_maxsize)
+        self.limiter = RateLimiter(max_rate, write_log=self.write_log)
+        self.retry_policy = retry_policy or RetryPolicy(cap=timeout)
+        self.breakers = dict()
+        self.lock = threading.Lock()
+        self.cache = cache
+        self.offline = offline
+        self.session_file = session_file
+        self.base_url = base_url or 'https://familysearch.org'
+        self.www_url = base_url or 'https://www.familysearch.org'
+        self.ident_url = base_url or 'https://ident.familysearch.org'
+        self.login_lock = threading.Lock()
+        self.fid = self.lang = self.display_name = self.fssessionid = None
+        self.in_flight = dict()
+        self.metrics = Metrics()
+        self.counter = self.retries = self.failures = self.trips = self.coalesced = 0
+        self.logged = True if offline else self.resume() or self.login()
 
     # Write in logfile if verbose enabled
     def write_log(self, text):
@@ -130,21 +607,23 @@ class Session:
 
     # retrieve FamilySearch session ID (https://familysearch.org/developers/docs/guides/oauth2)
     def login(self):
+        attempt = 0
         while True:
+            attempt += 1
             try:
-                url = 'https://www.familysearch.org/auth/familysearch/login'
+                url = self.www_url + '/auth/familysearch/login'
                 self.write_log('Downloading: ' + url)
-                r = requests.get(url, params={'ldsauth': False}, allow_redirects=False)
+                r = self.http.get(url, params={'ldsauth': False}, allow_redirects=False, timeout=self.timeout)
                 url = r.headers['Location']
                 self.write_log('Downloading: ' + url)
-                r = requests.get(url, allow_redirects=False)
+                r = self.http.get(url, allow_redirects=False, timeout=self.timeout)
                 idx = r.text.index('name="params" value="')
                 span = r.text[idx + 21:].index('"')
                 params = r.text[idx + 21:idx + 21 + span]
 
-                url = 'https://ident.familysearch.org/cis-web/oauth2/v3/authorization'
+                url = self.ident_url + '/cis-web/oauth2/v3/authorization'
                 self.write_log('Downloading: ' + url)
-                r = requests.post(url, data={'params': params, 'userName': self.username, 'password': self.password}, allow_redirects=False)
+                r = self.http.post(url, data={'params': params, 'userName': self.username, 'password': self.password}, allow_redirects=False, timeout=self.timeout)
 
                 if 'The username or password was incorrect' in r.text:
                     self.write_log('The username or password was incorrect')
@@ -152,87 +631,255 @@ class Session:
 
                 if 'Invalid Oauth2 Request' in r.text:
                     self.write_log('Invalid Oauth2 Request')
-                    time.sleep(self.timeout)
-                    continue
-
-                url = r.headers['Location']
-                self.write_log('Downloading: ' + url)
-                r = requests.get(url, allow_redirects=False)
-                self.fssessionid = r.cookies['fssessionid']
+                else:
+                    url = r.headers['Location']
+                    self.write_log('Downloading: ' + url)
+                    r = self.http.get(url, allow_redirects=False, timeout=self.timeout)
+                    self.fssessionid = r.cookies['fssessionid']
+                    self.write_log('FamilySearch session id: ' + self.fssessionid)
+                    self.save_session()
+                    return True
             except requests.exceptions.ReadTimeout:
                 self.write_log('Read timed out')
-                continue
             except requests.exceptions.ConnectionError:
                 self.write_log('Connection aborted')
-                time.sleep(self.timeout)
-                continue
             except requests.exceptions.HTTPError:
                 self.write_log('HTTPError')
-                time.sleep(self.timeout)
-                continue
             except KeyError:
                 self.write_log('KeyError')
-                time.sleep(self.timeout)
-                continue
             except ValueError:
                 self.write_log('ValueError')
-                time.sleep(self.timeout)
-                continue
-            self.write_log('FamilySearch session id: ' + self.fssessionid)
-            return True
+            delay = self.retry_delay('login', attempt)
+            if delay is None:
+                return False
+            time.sleep(delay)
+
+    # reuse the session ID of a previous run if FamilySearch still accepts it
+    def resume(self):
+        if not self.session_file or not os.path.exists(self.session_file):
+            return False
+        try:
+            with open(self.session_file, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved.get('username') != self.username or not saved.get('fssessionid'):
+            return False
+        try:
+            url = self.base_url + '/platform/users/current.json'
+            self.write_log('Downloading: ' + url)
+            r = self.http.get(url, cookies={'fssessionid': saved['fssessionid']}, timeout=self.timeout)
+            if r.status_code != 200:
+                self.write_log('Saved FamilySearch session expired')
+                return False
+            self.set_user(r.json())
+            # as set_current would have, so that --offline finds the user
+            if self.cache:
+                self.cache.put('/platform/users/current.json', r.content, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            return False
+        self.fssessionid = saved['fssessionid']
+        self.write_log('FamilySearch session id: ' + self.fssessionid + ' (resumed)')
+        return True
+
+    # store the session ID in a file only readable by the user
+    def save_session(self):
+        if not self.session_file:
+            return
+        tmp = self.session_file + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w', encoding='utf-8') as f:
+            json.dump({'username': self.username, 'fssessionid': self.fssessionid}, f)
+        os.replace(tmp, self.session_file)
+
+    # log in again after a 401, once for all the threads that were using the expired session ID
+    def relogin(self, fssessionid):
+        with self.login_lock:
+            if self.fssessionid == fssessionid:
+                self.login()
 
-    # retrieve JSON structure from FamilySearch URL
-    def get_url(self, url):
+    # record a failed attempt: returns the number of seconds to wait before the next one, or None when giving up
+    def retry_delay(self, url, attempt, delay=None):
+        if attempt >= self.retry_policy.max_attempts:
+            self.failures += 1
+            self.metrics.count(url, 'failures')
+            self.write_log('WARNING: giving up on %s after %s attempts' % (url, attempt))
+            return None
+        self.retries += 1
+        self.metrics.count(url, 'retries')
+        if delay is None:
+            delay = self.retry_policy.delay(attempt)
+        self.write_log('Retrying %s in %.1f seconds' % (url, delay))
+        return delay
+
+    # seconds to wait for the probe of an endpoint that failed, which use up no attempt; None once the request
+    # waited more than BREAKER_WAIT seconds in all and gives up
+    def breaker_delay(self, url, waited, wait):
+        if waited >= BREAKER_WAIT:
+            self.failures += 1
+            self.metrics.count(url, 'failures')
+            self.write_log('WARNING: giving up on %s after waiting %s seconds for the endpoint' % (url, round(waited)))
+            return None
+        return wait
+
+    # circuit breaker of the endpoint of an URL
+    def breaker(self, url):
+        key = endpoint(url)
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(key, self)
+            return self.breakers[key]
+
+    # retrieve JSON structure from FamilySearch URL, sharing the download with concurrent callers of the same URL
+    def get_url(self, url, urgent=False):
+        leader = False
+        with self.lock:
+            call = self.in_flight.get(url)
+            if call:
+                self.coalesced += 1
+            else:
+                call = self.in_flight[url] = InFlight()
+                leader = True
+        if not leader:
+            call.done.wait()
+            return call.result
+        try:
+            call.result = self.download_url(url, urgent)
+        finally:
+            with self.lock:
+                del self.in_flight[url]
+            call.done.set()
+        return call.result
+
+    def download_url(self, url, urgent=False):
+        served, data, entry = self.from_cache(url)
+        if served:
+            return data
         self.counter += 1
+        breaker = self.breaker(url)
+        attempt = waited = 0
         while True:
+            wait = breaker.allow()
+            if wait:
+                # the endpoint is down: wait for the probe, without sending anything
+                delay = self.breaker_delay(url, waited, wait)
+                if delay is None:
+                    return None
+                waited += delay
+                time.sleep(delay)
+                continue
+            wait = self.limiter.reserve(urgent)
+            if wait:
+                time.sleep(wait)
+                continue
+            attempt += 1
+            start = time.time()
+            fssessionid = self.fssessionid
+            status_code = retry_after = None
+            content = b''
             try:
                 self.write_log('Downloading: ' + url)
                 # r = requests.get(url, cookies = { 's_vi': self.s_vi, 'fssessionid' : self.fssessionid }, timeout = self.timeout)
-                r = requests.get('https://familysearch.org' + url, cookies={'fssessionid': self.fssessionid}, timeout=self.timeout)
+                headers = entry.conditional_headers() if entry else dict()
+                headers['Accept'] = 'application/json'
+                r = self.http.get(self.base_url + url, cookies={'fssessionid': fssessionid}, headers=headers, timeout=self.timeout)
+                content = r.content
+                status_code = r.status_code
+                retry_after = retry_after_seconds(r.headers.get('Retry-After'))
             except requests.exceptions.ReadTimeout:
                 self.write_log('Read timed out')
-                continue
-            except requests.exceptions.ConnectionError:
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
                 self.write_log('Connection aborted')
-                time.sleep(self.timeout)
-                continue
-            self.write_log('Status code: ' + str(r.status_code))
-            if r.status_code == 204:
-                return None
-            if r.status_code in {404, 405, 410, 500}:
-                self.write_log('WARNING: ' + url)
-                return None
-            if r.status_code == 401:
-                self.login()
+            finally:
+                # the slot is given back whatever happened to the request
+                self.limiter.release(time.time() - start, status_code, retry_after)
+                self.metrics.record(url, status_code or 'error', time.time() - start, len(content))
+            if status_code is None:
+                action = 'retry'
+            else:
+                action, data = self.read_response(url, status_code, r.headers, content, entry)
+            if action in {'retry', 'throttle'}:
+                # a 429 is only a request to slow down, the endpoint is not failing
+                if action == 'retry' or status_code == 503:
+                    breaker.failure()
+                delay = self.retry_delay(url, attempt, retry_after)
+                if delay is None:
+                    return None
+                time.sleep(delay)
                 continue
-            try:
-                r.raise_for_status()
-            except requests.exceptions.HTTPError:
-                self.write_log('HTTPError')
-                if r.status_code == 403:
-                    if 'message' in r.json()['errors'][0] and r.json()['errors'][0]['message'] == u'Unable to get ordinances.':
-                        self.write_log('Unable to get ordinances. Try with an LDS account or without option -c.')
-                        return 'error'
-                    else:
-
-                        self.write_log('WARNING: code 403 from %s %s' % (url, r.json()['errors'][0]['message'] or ''))
-                        return None
-                time.sleep(self.timeout)
-                continue
-            try:
-                return r.json()
-            except Exception as e:
-                self.write_log('WARNING: corrupted file from %s, error: %s' % (url, e))
-                return None
+            breaker.success()
+            if action == 'login':
+                self.relogin(fssessionid)
+            elif action == 'done':
+                return data
+
+    # look an URL up in the response cache: returns (True, data, entry) when it is served without asking the server
+    def from_cache(self, url):
+        entry = self.cache.get(url) if self.cache else None
+        if entry and (entry.fresh or self.offline):
+            self.cache.hits += 1
+            self.metrics.count(url, 'cache_hits')
+            return True, entry.json(), entry
+        if self.offline:
+            self.write_log('WARNING: not in cache: ' + url)
+            return True, None, None
+        return False, None, entry
+
+    # interpret a response, revalidating or updating the cache
+    def read_response(self, url, status_code, headers, body, entry):
+        if status_code == 304 and entry:
+            self.write_log('Not modified: ' + url)
+            self.cache.revalidations += 1
+            self.cache.refresh(url)
+            return 'done', entry.json()
+        action, data = self.check_response(url, status_code, lambda: json.loads(body.decode('utf-8')))
+        if self.cache and status_code == 200 and data is not None:
+            self.cache.put(url, body, headers.get('ETag'), headers.get('Last-Modified'))
+        return action, data
+
+    # interpret a response: returns ('done', data), ('login', None), ('throttle', None) or ('retry', None)
+    def check_response(self, url, status_code, get_json):
+        self.write_log('Status code: ' + str(status_code))
+        if status_code == 204:
+            return 'done', None
+        if status_code in {404, 405, 410, 500}:
+            self.write_log('WARNING: ' + url)
+            return 'done', None
+        if status_code == 401:
+            return 'login', None
+        if status_code in {429, 503}:
+            # the rate limiter has already backed off, the request is retried after Retry-After or the backoff
+            self.write_log('WARNING: throttled on ' + url)
+            return 'throttle', None
+        if status_code >= 400:
+            self.write_log('HTTPError')
+            if status_code == 403:
+                if 'message' in get_json()['errors'][0] and get_json()['errors'][0]['message'] == u'Unable to get ordinances.':
+                    self.write_log('Unable to get ordinances. Try with an LDS account or without option -c.')
+                    return 'done', 'error'
+                else:
+
+                    self.write_log('WARNING: code 403 from %s %s' % (url, get_json()['errors'][0]['message'] or ''))
+                    return 'done', None
+            return 'retry', None
+        try:
+            return 'done', get_json()
+        except Exception as e:
+            self.write_log('WARNING: corrupted file from %s, error: %s' % (url, e))
+            return 'done', None
 
     # retrieve FamilySearch current user ID
     def set_current(self):
         url = '/platform/users/current.json'
         data = self.get_url(url)
         if data:
-            self.fid = data['users'][0]['personId']
-            self.lang = data['users'][0]['preferredLanguage']
-            self.display_name = data['users'][0]['displayName']
+            self.set_user(data)
+
+    def set_user(self, data):
+        self.fid = data['users'][0]['personId']
+        self.lang = data['users'][0]['preferredLanguage']
+        self.display_name = data['users'][0]['displayName']
 
     def get_userid(self):
         if not self.fid:
@@ -247,21 +894,208 @@ class Session:
         return string
 
 
+# bound on the requests in flight of an event loop, whose free slots go to the urgent requests first
+class Slots:
+    def __init__(self, size):
+        self.free = size
+        # futures of the urgent and of the other requests waiting for a slot
+        self.waiting = (collections.deque(), collections.deque())
+
+    async def acquire(self, urgent=False):
+        if self.free and not self.waiting[0] and (urgent or not self.waiting[1]):
+            self.free -= 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        queue = self.waiting[0 if urgent else 1]
+        queue.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future in queue:
+                queue.remove(future)
+            elif not future.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release()
+            raise
+
+    # hand the slot over to the first urgent request waiting, otherwise to the first other one
+    def release(self):
+        for queue in self.waiting:
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.free += 1
+
+
+# FamilySearch asynchronous session class, sharing the login of a Session
+class AsyncSession:
+    def __init__(self, fs, max_in_flight=MAX_IN_FLIGHT):
+        self.fs = fs
+        self.max_in_flight = max_in_flight
+        # the window of the rate limiter grows up to the configured requests in flight
+        fs.limiter.max_window = max(fs.limiter.max_window, max_in_flight)
+        self.slots = None
+        self.http = None
+        self.in_flight = dict()
+
+    # retrieve JSON structure from FamilySearch URL without holding a thread, sharing the download with concurrent callers of the same URL
+    async def get_url(self, url, urgent=False):
+        if url in self.in_flight:
+            self.fs.coalesced += 1
+            return await asyncio.shield(self.in_flight[url])
+        future = self.in_flight[url] = asyncio.get_event_loop().create_future()
+        try:
+            future.set_result(await self.download_url(url, urgent))
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+        finally:
+            del self.in_flight[url]
+        return future.result()
+
+    async def download_url(self, url, urgent=False):
+        if not self.http:
+            # bound to the running event loop, hence created on first use
+            self.slots = Slots(self.max_in_flight)
+            self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_in_flight), timeout=aiohttp.ClientTimeout(total=self.fs.timeout))
+        served, data, entry = self.fs.from_cache(url)
+        if served:
+            return data
+        self.fs.counter += 1
+        breaker = self.fs.breaker(url)
+        attempt = waited = 0
+        while True:
+            wait = breaker.allow()
+            if wait:
+                delay = self.fs.breaker_delay(url, waited, wait)
+                if delay is None:
+                    return None
+                waited += delay
+                await asyncio.sleep(delay)
+                continue
+            await self.slots.acquire(urgent)
+            try:
+                wait = self.fs.limiter.reserve(urgent)
+                if not wait:
+                    attempt += 1
+                    start = time.time()
+                    fssessionid = self.fs.fssessionid
+                    status_code = retry_after = None
+                    body = b''
+                    try:
+                        self.fs.write_log('Downloading: ' + url)
+                        headers = entry.conditional_headers() if entry else dict()
+                        headers['Accept'] = 'application/json'
+                        async with self.http.get(self.fs.base_url + url, cookies={'fssessionid': fssessionid}, headers=headers) as r:
+                            response_headers = r.headers
+                            body = await r.read()
+                            status_code = r.status
+                            retry_after = retry_after_seconds(response_headers.get('Retry-After'))
+                    except asyncio.TimeoutError:
+                        self.fs.write_log('Read timed out')
+                    except aiohttp.ClientError:
+                        self.fs.write_log('Connection aborted')
+                    finally:
+                        # the slot is given back whatever happened to the request, cancellation included
+                        self.fs.limiter.release(time.time() - start, status_code, retry_after)
+                        self.fs.metrics.record(url, status_code or 'error', time.time() - start, len(body))
+                    if status_code is None:
+                        action = 'retry'
+                    else:
+                        action, data = self.fs.read_response(url, status_code, response_headers, body, entry)
+            finally:
+                self.slots.release()
+            if wait:
+                # the slot is given back while the rate limiter holds the request back
+                await asyncio.sleep(wait)
+                continue
+            if action in {'retry', 'throttle'}:
+                # a 429 is only a request to slow down, the endpoint is not failing
+                if action == 'retry' or status_code == 503:
+                    breaker.failure()
+                delay = self.fs.retry_delay(url, attempt, retry_after)
+                if delay is None:
+                    return None
+                await asyncio.sleep(delay)
+                continue
+            breaker.success()
+            if action == 'login':
+                await asyncio.get_event_loop().run_in_executor(None, self.fs.relogin, fssessionid)
+            elif action == 'done':
+                return data
+
+    async def close(self):
+        if self.http:
+            await self.http.close()
+
+
+# numbers of the GEDCOM records of a tree, allocated under a lock so that records built by several threads at once
+# (the trees of an export server) never get the same number
+class Registry:
+    KINDS = ('indi', 'fam', 'note', 'source')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.counters = dict.fromkeys(self.KINDS, 0)
+        # first note of the tree with each text
+        self.texts = dict()
+
+    # number of a new record of a kind
+    def new(self, kind):
+        with self.lock:
+            self.counters[kind] += 1
+            return self.counters[kind]
+
+    # number read for a record of a kind: new records are numbered after it
+    def seen(self, kind, num):
+        with self.lock:
+            self.counters[kind] = max(self.counters[kind], num)
+        return num
+
+    # note of the tree with this text, created if the tree has none yet
+    def note(self, text, tree):
+        with self.lock:
+            return self.texts.get(text.strip()) or Note(text, tree)
+
+    def add_note(self, note, tree):
+        with self.lock:
+            tree.notes.append(note)
+            self.texts.setdefault(note.text, note)
+
+    # index the notes of the tree again once they were replaced
+    def index(self, notes):
+        with self.lock:
+            self.texts = dict()
+            for note in notes:
+                self.texts.setdefault(note.text, note)
+
+    # numbers of the records as saved in a checkpoint
+    def save(self):
+        with self.lock:
+            return dict(self.counters)
+
+    # numbers of the records saved in a checkpoint, also as the tuple saved by earlier versions
+    def restore(self, counters):
+        with self.lock:
+            self.counters = dict(zip(self.KINDS, counters)) if isinstance(counters, tuple) else dict(counters)
+
+
+# numbers of the records built without a tree
+ORPHANS = Registry()
+
+
 # some GEDCOM objects
 class Note:
 
-    counter = 0
-
     def __init__(self, text='', tree=None, num=None):
-        if num:
-            self.num = num
-        else:
-            Note.counter += 1
-            self.num = Note.counter
+        registry = tree.registry if tree else ORPHANS
+        self.num = registry.seen('note', num) if num else registry.new('note')
         self.text = text.strip()
 
         if tree:
-            tree.notes.append(self)
+            registry.add_note(self, tree)
 
     def print(self, file=sys.stdout):
         file.write(cont('0 @N' + str(self.num) + '@ NOTE ' + self.text) + '\n')
@@ -272,14 +1106,9 @@ class Note:
 
 class Source:
 
-    counter = 0
-
     def __init__(self, data=None, tree=None, num=None):
-        if num:
-            self.num = num
-        else:
-            Source.counter += 1
-            self.num = Source.counter
+        registry = tree.registry if tree else ORPHANS
+        self.num = registry.seen('source', num) if num else registry.new('source')
 
         self.tree = tree
         self.url = self.citation = self.title = self.fid = None
@@ -443,15 +1272,10 @@ class Ordinance:
 # GEDCOM individual class
 class Indi:
 
-    counter = 0
-
     # initialize individual
     def __init__(self, fid=None, tree=None, num=None):
-        if num:
-            self.num = num
-        else:
-            Indi.counter += 1
-            self.num = Indi.counter
+        registry = tree.registry if tree else ORPHANS
+        self.num = registry.seen('indi', num) if num else registry.new('indi')
         self.fid = fid
         self.tree = tree
         self.famc_fid = set()
@@ -473,8 +1297,17 @@ class Indi:
         self.sources = set()
         self.memories = set()
 
-    def add_data(self, data):
+    # the downloads come first and the data is applied at once, so that a checkpoint never holds half an individual
+    async def add_data(self, data):
         if data:
+            sources = memorie = None
+            quotes = dict()
+            if 'sources' in data:
+                for quote in data['sources']:
+                    quotes[quote['descriptionId']] = quote.get('attribution', {}).get('changeMessage')
+                sources = await self.tree.get_sources(quotes, '/platform/tree/persons/%s/sources.json' % self.fid)
+            if 'evidence' in data:
+                memorie = await self.tree.get_url('/platform/tree/persons/%s/memories.json' % self.fid)
             if data['names']:
                 for x in data['names']:
                     if x['preferred']:
@@ -501,26 +1334,17 @@ class Indi:
                         self.notes.add(Note('=== ' + self.tree.fs._('Life Sketch') + ' ===\n' + x['value'], self.tree))
                     else:
                         self.facts.add(Fact(x, self.tree))
-            if 'sources' in data:
-                sources = self.tree.fs.get_url('/platform/tree/persons/%s/sources.json' % self.fid)
-                if sources:
-                    quotes = dict()
-                    for quote in sources['persons'][0]['sources']:
-                        quotes[quote['descriptionId']] = quote['attribution']['changeMessage'] if 'changeMessage' in quote['attribution'] else None
-                    for source in sources['sourceDescriptions']:
-                        if source['id'] not in self.tree.sources:
-                            self.tree.sources[source['id']] = Source(source, self.tree)
-                        self.sources.add((self.tree.sources[source['id']], quotes[source['id']]))
-            if 'evidence' in data:
-                url = '/platform/tree/persons/%s/memories.json' % self.fid
-                memorie = self.tree.fs.get_url(url)
-                if memorie and 'sourceDescriptions' in memorie:
-                    for x in memorie['sourceDescriptions']:
-                        if x['mediaType'] == 'text/plain':
-                            text = '\n'.join(val.get('value', '') for val in x.get('titles', []) + x.get('descriptions', []))
-                            self.notes.add(Note(text, self.tree))
-                        else:
-                            self.memories.add(Memorie(x))
+            if sources:
+                for source_fid, source in sources.items():
+                    self.sources.add((source, quotes[source_fid]))
+            if memorie and 'sourceDescriptions' in memorie:
+                for x in memorie['sourceDescriptions']:
+                    if x['mediaType'] == 'text/plain':
+                        text = '\n'.join(val.get('value', '') for val in x.get('titles', []) + x.get('descriptions', []))
+                        self.notes.add(Note(text, self.tree))
+                    else:
+                        self.memories.add(Memorie(x))
+        self.tree.details.pop(self.fid, None)
 
     # add a fams to the individual
     def add_fams(self, fams):
@@ -531,20 +1355,23 @@ class Indi:
         self.famc_fid.add(famc)
 
     # retrieve individual notes
-    def get_notes(self):
-        notes = self.tree.fs.get_url('/platform/tree/persons/%s/notes.json' % self.fid)
+    async def get_notes(self):
+        notes = await self.tree.get_url('/platform/tree/persons/%s/notes.json' % self.fid)
         if notes:
             for n in notes['persons'][0]['notes']:
                 text_note = '=== ' + n['subject'] + ' ===\n' if 'subject' in n else ''
                 text_note += n['text'] + '\n' if 'text' in n else ''
                 self.notes.add(Note(text_note, self.tree))
+        self.tree.finish('notes', self.fid)
 
     # retrieve LDS ordinances
-    def get_ordinances(self):
+    async def get_ordinances(self):
         res = []
         famc = False
         url = '/platform/tree/persons/%s/ordinances.json' % self.fid
-        data = self.tree.fs.get_url(url)['persons'][0]['ordinances']
+        data = await self.tree.get_url(url)
+        # None when the download was given up, 'error' without access to the ordinances
+        data = data['persons'][0]['ordinances'] if isinstance(data, dict) else None
         if data:
             for o in data:
                 if o['type'] == u'http://lds.org/Baptism':
@@ -563,20 +1390,17 @@ class Indi:
         return res, famc
 
     # retrieve contributors
-    def get_contributors(self):
+    async def get_contributors(self):
         temp = set()
-        data = self.tree.fs.get_url('/platform/tree/persons/%s/changes.json' % self.fid)
+        data = await self.tree.get_url('/platform/tree/persons/%s/changes.json' % self.fid)
         if data:
             for entries in data['entries']:
                 for contributors in entries['contributors']:
                     temp.add(contributors['name'])
         if temp:
             text = '=== ' + self.tree.fs._('Contributors') + ' ===\n' + '\n'.join(sorted(temp))
-            for n in self.tree.notes:
-                if n.text == text:
-                    self.notes.add(n)
-                    return
-            self.notes.add(Note(text, self.tree))
+            self.notes.add(self.tree.registry.note(text, self.tree))
+        self.tree.finish('contributors', self.fid)
 
     # print individual information in GEDCOM format
     def print(self, file=sys.stdout):
@@ -624,15 +1448,11 @@ class Indi:
 
 # GEDCOM family class
 class Fam:
-    counter = 0
 
     # initialize family
     def __init__(self, husb=None, wife=None, tree=None, num=None):
-        if num:
-            self.num = num
-        else:
-            Fam.counter += 1
-            self.num = Fam.counter
+        registry = tree.registry if tree else ORPHANS
+        self.num = registry.seen('fam', num) if num else registry.new('fam')
         self.husb_fid = husb if husb else None
         self.wife_fid = wife if wife else None
         self.tree = tree
@@ -649,55 +1469,50 @@ class Fam:
         if child not in self.chil_fid:
             self.chil_fid.add(child)
 
-    # retrieve and add marriage information
-    def add_marriage(self, fid):
+    # retrieve and add marriage information, applied after the downloads
+    async def add_marriage(self, fid):
         if not self.fid:
             self.fid = fid
             url = '/platform/tree/couple-relationships/%s.json' % self.fid
-            data = self.tree.fs.get_url(url)
-            if data:
-                if 'facts' in data['relationships'][0]:
-                    for x in data['relationships'][0]['facts']:
-                        self.facts.add(Fact(x, self.tree))
-                if 'sources' in data['relationships'][0]:
-                    quotes = dict()
-                    for x in data['relationships'][0]['sources']:
-                        quotes[x['descriptionId']] = x['attribution']['changeMessage'] if 'changeMessage' in x['attribution'] else None
-                    new_sources = quotes.keys() - self.tree.sources.keys()
-                    if new_sources:
-                        sources = self.tree.fs.get_url('/platform/tree/couple-relationships/%s/sources.json' % self.fid)
-                        for source in sources['sourceDescriptions']:
-                            if source['id'] in new_sources and source['id'] not in self.tree.sources:
-                                self.tree.sources[source['id']] = Source(source, self.tree)
-                    for source_fid in quotes:
-                        self.sources.add((self.tree.sources[source_fid], quotes[source_fid]))
+            data = await self.tree.get_url(url)
+            quotes = dict()
+            if data and 'sources' in data['relationships'][0]:
+                for x in data['relationships'][0]['sources']:
+                    quotes[x['descriptionId']] = x['attribution']['changeMessage'] if 'changeMessage' in x['attribution'] else None
+            sources = await self.tree.get_sources(quotes, '/platform/tree/couple-relationships/%s/sources.json' % self.fid)
+            if data and 'facts' in data['relationships'][0]:
+                for x in data['relationships'][0]['facts']:
+                    self.facts.add(Fact(x, self.tree))
+            for source_fid, source in sources.items():
+                self.sources.add((source, quotes[source_fid]))
+            self.tree.finish('marriage', (self.husb_fid, self.wife_fid))
+            for phase in set(self.tree.prefetch) - {'ordinances'}:
+                self.tree.queue_details(phase, [(self.husb_fid, self.wife_fid)])
 
     # retrieve marriage notes
-    def get_notes(self):
+    async def get_notes(self):
         if self.fid:
-            notes = self.tree.fs.get_url('/platform/tree/couple-relationships/%s/notes.json' % self.fid)
+            notes = await self.tree.get_url('/platform/tree/couple-relationships/%s/notes.json' % self.fid)
             if notes:
                 for n in notes['relationships'][0]['notes']:
                     text_note = '=== ' + n['subject'] + ' ===\n' if 'subject' in n else ''
                     text_note += n['text'] + '\n' if 'text' in n else ''
                     self.notes.add(Note(text_note, self.tree))
+        self.tree.finish('notes', (self.husb_fid, self.wife_fid))
 
     # retrieve contributors
-    def get_contributors(self):
+    async def get_contributors(self):
         if self.fid:
             temp = set()
-            data = self.tree.fs.get_url('/platform/tree/couple-relationships/%s/changes.json' % self.fid)
+            data = await self.tree.get_url('/platform/tree/couple-relationships/%s/changes.json' % self.fid)
             if data:
                 for entries in data['entries']:
                     for contributors in entries['contributors']:
                         temp.add(contributors['name'])
             if temp:
                 text = '=== ' + self.tree.fs._('Contributors') + ' ===\n' + '\n'.join(sorted(temp))
-                for n in self.tree.notes:
-                    if n.text == text:
-                        self.notes.add(n)
-                        return
-                self.notes.add(Note(text, self.tree))
+                self.notes.add(self.tree.registry.note(text, self.tree))
+        self.tree.finish('contributors', (self.husb_fid, self.wife_fid))
 
     # print family information in GEDCOM format
     def print(self, file=sys.stdout):
@@ -723,60 +1538,611 @@ class Fam:
                 file.write(cont('2 PAGE ' + quote) + '\n')
 
 
+# pickler of the tree state: the tree referenced by individuals, families and sources is not saved
+class TreePickler(pickle.Pickler):
+    def __init__(self, file, tree):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.tree = tree
+
+    def persistent_id(self, obj):
+        return 'tree' if obj is self.tree else None
+
+
+# unpickler of the tree state: the references to the saved tree point to the tree loading it
+class TreeUnpickler(pickle.Unpickler):
+    def __init__(self, file, tree):
+        super().__init__(file)
+        self.tree = tree
+
+    def persistent_load(self, pid):
+        return self.tree
+
+    # only the classes of the tree are loaded, saved as __main__ when run as a script: the files may be written by
+    # other processes, and any other global could run code
+    def find_class(self, module, name):
+        if module in ('__main__', 'getmyancestors') and name in (Indi.__name__, Fam.__name__, Note.__name__, Source.__name__, Fact.__name__, Memorie.__name__, Name.__name__, Ordinance.__name__):
+            return globals()[name]
+        raise pickle.UnpicklingError('%s.%s is not allowed in a tree file' % (module, name))
+
+
 # family tree class
 class Tree:
-    def __init__(self, fs=None):
+    def __init__(self, fs=None, afs=None, persons=None, max_batches=MAX_BATCHES, checkpoint=None, checkpoint_interval=CHECKPOINT_INTERVAL, budget=None, loop=None):
         self.fs = fs
+        self.afs = afs
+        self.persons = persons
+        self.budget = budget or Budget()
+        self.max_batches = max_batches
+        self.batches = None
+        # downloads of source descriptions, by ID, so that each description is downloaded once however many times it is cited
+        self.source_downloads = dict()
+        self.source_slots = None
+        # numbers of the individuals, families, notes and sources
+        self.registry = Registry()
         self.indi = dict()
         self.fam = dict()
         self.notes = list()
         self.sources = dict()
         self.places = dict()
-
-    # add individuals to the family tree
+        # persons.json structures of the individuals whose details are still downloading
+        self.details = dict()
+        # individuals and families for which each detail phase finished
+        self.done = dict()
+        # IDs waiting for download in the crawl, with the generations left to ascend and to descend
+        self.frontier = dict()
+        # generations of ancestors and descendants already discovered from each individual with the bulk endpoints
+        self.discovered = {'ancestry': dict(), 'descendancy': dict()}
+        # IDs of the individuals asked for by this run
+        self.reached = set()
+        # IDs of the individuals of a previous export, whose relationships beyond the export are not known yet
+        self.seeded = set()
+        # generations between each individual reached by the crawl and the starting individuals
+        self.distance = dict()
+        # IDs left undownloaded because the budget was used up
+        self.unexplored = set()
+        # phases of details downloaded as soon as the individuals and families are created, see prefetch_details
+        self.prefetch = list()
+        # downloads of ordinances, notes and contributors: iterators of the keys waiting for each phase, downloads
+        # running by phase, keys downloading, workers and their number by phase
+        self.detail_queues = dict()
+        self.detail_running = dict.fromkeys(DETAIL_WORKERS, 0)
+        self.detail_keys = set()
+        self.detail_workers = set()
+        self.detail_limits = dict(DETAIL_WORKERS)
+        # ordinances downloaded whose families are not linked yet
+        self.sealings = dict()
+        self.started = time.time()
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.saved = time.time()
+        # download threads, as many as keep-alive connections in the HTTP pool (only used without an AsyncSession)
+        self.executor = ThreadPoolExecutor(max_workers=fs.pool_maxsize if fs else POOL_MAXSIZE)
+        # threads of the persons.json batches, so that they do not queue behind the other downloads
+        self.urgent_executor = ThreadPoolExecutor(max_workers=max_batches)
+        self.loop = loop or asyncio.new_event_loop()
+
+    # run a coroutine to completion on the tree event loop
+    def run(self, coroutine):
+        return self.loop.run_until_complete(self.with_checkpoints(coroutine) if self.checkpoint else coroutine)
+
+    # save a checkpoint every checkpoint_interval seconds while a coroutine runs:
+    # saved from the event loop thread between two steps of the coroutine, hence always consistent
+    async def with_checkpoints(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        while not task.done():
+            await asyncio.wait([task], timeout=max(0, self.saved + self.checkpoint_interval - time.time()))
+            if not task.done():
+                self.save()
+        return task.result()
+
+    # write the tree state to the checkpoint file, compressed and atomically
+    def save(self, path=None):
+        path = path or self.checkpoint
+        file = io.BytesIO()
+        TreePickler(file, self).dump({
+            'version': CHECKPOINT_VERSION,
+            'started': self.started,
+            'counters': self.registry.save(),
+            'indi': self.indi,
+            'fam': self.fam,
+            'notes': self.notes,
+            'sources': self.sources,
+            'places': self.places,
+            'details': self.details,
+            'done': self.done,
+            'frontier': self.frontier,
+            'discovered': self.discovered,
+            'reached': self.reached,
+            'seeded': self.seeded,
+            'distance': self.distance,
+        })
+        with open(path + '.tmp', 'wb') as f:
+            f.write(zlib.compress(file.getvalue(), 1))
+        os.replace(path + '.tmp', path)
+        self.saved = time.time()
+        if self.fs:
+            self.fs.write_log('Checkpoint: %s individuals, %s families and %s IDs in the frontier saved in %s' % (len(self.indi), len(self.fam), len(self.frontier), path))
+
+    # load the tree state from the checkpoint file and finish the details that were downloading when it was saved:
+    # returns False if there is no checkpoint of the current format
+    def restore(self, path=None):
+        try:
+            with open(path or self.checkpoint, 'rb') as f:
+                state = TreeUnpickler(io.BytesIO(zlib.decompress(f.read())), self).load()
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return False
+        if state.get('version') != CHECKPOINT_VERSION:
+            return False
+        self.registry.restore(state['counters'])
+        self.started = state['started']
+        self.reached = state['reached']
+        self.seeded = state.get('seeded', set())
+        self.distance = state.get('distance', dict())
+        self.indi = state['indi']
+        self.fam = state['fam']
+        self.notes = state['notes']
+        self.registry.index(self.notes)
+        self.sources = state['sources']
+        self.places = state['places']
+        self.details = state['details']
+        self.done = state['done']
+        self.frontier = state['frontier']
+        self.discovered = state['discovered']
+        # marriages still downloading are downloaded again
+        for key, fam in self.fam.items():
+            if not self.finished('marriage', key):
+                fam.fid = None
+        async def finish_details():
+            await asyncio.gather(*(self.indi[fid].add_data(data) for fid, data in list(self.details.items())))
+
+        self.run(finish_details())
+        return True
+
+    # forget the individuals and couples changed since the run that saved the restored state, according to their change history,
+    # so that only them are downloaded again by this run: returns their numbers
+    def refresh(self):
+        since = self.started
+        self.started = time.time()
+        self.reached = set()
+        self.distance = dict()
+        if self.fs.cache:
+            self.fs.cache.since = self.started
+
+        async def changed(url):
+            data = await self.get_url(url)
+            # IDs that were deleted or merged are downloaded again as well
+            return not data or any(entry.get('updated', 0) / 1000 > since for entry in data.get('entries', []))
+
+        async def check(urls):
+            return await asyncio.gather(*(changed(url) for url in urls))
+
+        fids = list(self.indi)
+        couples = [(key, fam) for key, fam in self.fam.items() if fam.fid]
+        res = self.run(check(['/platform/tree/persons/%s/changes.json' % fid for fid in fids] + ['/platform/tree/couple-relationships/%s/changes.json' % fam.fid for key, fam in couples]))
+        persons = [fid for fid, flag in zip(fids, res) if flag]
+        couples = [(key, fam) for (key, fam), flag in zip(couples, res[len(fids):]) if flag]
+        for fid in persons:
+            del self.indi[fid]
+            self.details.pop(fid, None)
+            for keys in self.done.values():
+                keys.discard(fid)
+        for key, fam in couples:
+            fam.fid = None
+            fam.facts = set()
+            fam.sources = set()
+            fam.notes = set()
+            for keys in self.done.values():
+                keys.discard(key)
+        if self.persons:
+            self.persons.remove(persons)
+        # families are linked again by this run
+        for indi in self.indi.values():
+            indi.famc_fid = set()
+            indi.fams_fid = set()
+        for fam in self.fam.values():
+            fam.chil_fid = set()
+        return len(persons), len(couples)
+
+    # drop the individuals this run did not reach, then the families, notes and sources nobody uses anymore
+    def prune(self):
+        for fid in self.indi.keys() - self.reached:
+            del self.indi[fid]
+        keys = set()
+        for indi in self.indi.values():
+            keys |= indi.famc_fid | indi.fams_fid
+        for key in self.fam.keys() - keys:
+            del self.fam[key]
+        families = set(self.fam.values())
+        for indi in self.indi.values():
+            if indi.sealing_child and indi.sealing_child.famc not in families:
+                indi.sealing_child.famc = None
+        self.notes, self.sources = self.used(self)
+        self.registry.index(self.notes)
+
+    # notes and sources of this tree that the individuals and families of a tree use
+    def used(self, tree):
+        notes = set()
+        sources = set()
+        for indi in tree.indi.values():
+            for name in {indi.name} | indi.nicknames | indi.birthnames | indi.aka | indi.married:
+                if name:
+                    notes.add(name.note)
+            notes |= {fact.note for fact in indi.facts} | indi.notes
+            sources |= {source for source, quote in indi.sources}
+        for fam in tree.fam.values():
+            notes |= {fact.note for fact in fam.facts} | fam.notes
+            sources |= {source for source, quote in fam.sources}
+        for source in sources:
+            notes |= source.notes
+        return [note for note in self.notes if note in notes], {fid: source for fid, source in self.sources.items() if source in sources}
+
+    # tree of some individuals and of the relationships between them, for the GEDCOM file of a batch job: the individuals
+    # and families are copies without the links to the others; without marriages, the couples are left as without -m
+    def select(self, fids, marriages=True):
+        tree = Tree(self.fs, loop=self.loop)
+        tree.registry = self.registry
+        fids = fids & self.indi.keys()
+        for key, fam in self.fam.items():
+            if all(fid is None or fid in fids for fid in key) and (fam.chil_fid & fids or marriages and fam.fid):
+                tree.fam[key] = copy.copy(fam)
+                tree.fam[key].chil_fid = fam.chil_fid & fids
+                if not marriages:
+                    tree.fam[key].fid = None
+                    tree.fam[key].facts, tree.fam[key].sources, tree.fam[key].notes = set(), set(), set()
+        for fid in fids:
+            indi = tree.indi[fid] = copy.copy(self.indi[fid])
+            indi.famc_fid = indi.famc_fid & tree.fam.keys()
+            indi.fams_fid = indi.fams_fid & tree.fam.keys()
+            famc = indi.sealing_child.famc if indi.sealing_child else None
+            if famc and (famc.husb_fid, famc.wife_fid) not in tree.fam:
+                indi.sealing_child = copy.copy(indi.sealing_child)
+                indi.sealing_child.famc = None
+        tree.notes, tree.sources = self.used(tree)
+        return tree
+
+    # load a previous export: its individuals and families are taken as downloaded with their details,
+    # their relationships are the ones of the export until they are needed beyond it
+    def load_gedcom(self, file):
+        from mergemyancestors import Gedcom
+        ged = Gedcom(file, self)
+        # the export may have been made without -c, -m or -r: only the details it holds are taken as downloaded
+        header = '=== ' + self.fs._('Contributors') + ' ===\n'
+
+        def finish_contributors(key, record):
+            if any(note.text.startswith(header) for note in record.notes):
+                self.finish('contributors', key)
+
+        for indi in ged.indi.values():
+            self.indi[indi.fid] = indi
+            self.seeded.add(indi.fid)
+            indi.parents = set(indi.famc_fid)
+            self.finish('notes', indi.fid)
+            finish_contributors(indi.fid, indi)
+            # a sealing to parents outside of the export gets its family once they are downloaded
+            if (indi.baptism or indi.confirmation or indi.endowment or indi.sealing_child) and (not indi.sealing_child or indi.sealing_child.famc):
+                self.finish('ordinances', indi.fid)
+        for fam in ged.fam.values():
+            key = (fam.husb_fid, fam.wife_fid)
+            self.fam[key] = fam
+            for fid in key:
+                if fid in self.indi:
+                    self.indi[fid].children |= {(fam.husb_fid, fam.wife_fid, child) for child in fam.chil_fid}
+                    if fam.fid and fam.husb_fid and fam.wife_fid:
+                        self.indi[fid].spouses.add((fam.husb_fid, fam.wife_fid, fam.fid))
+            # the marriage, notes and contributors of a couple are only downloaded with -m
+            if fam.fid:
+                self.finish('marriage', key)
+                self.finish('notes', key)
+                finish_contributors(key, fam)
+        # new objects are numbered after those of the export
+        for kind, records in (('indi', ged.indi), ('fam', ged.fam), ('note', ged.note), ('source', ged.sour)):
+            self.registry.seen(kind, max([0] + list(records)))
+        # the parser fills the text of a note after creating it: the contributor notes of the export are shared by text
+        self.registry.index(self.notes)
+        return len(ged.indi), len(ged.fam)
+
+    # record that a detail phase finished for an individual or a family
+    def finish(self, phase, key):
+        self.done.setdefault(phase, set()).add(key)
+
+    def finished(self, phase, key):
+        return key in self.done.get(phase, ())
+
+    # retrieve JSON structure from FamilySearch URL, natively asynchronous when an AsyncSession is available;
+    # urgent requests go ahead of the others
+    async def get_url(self, url, urgent=False):
+        if self.afs:
+            return await self.afs.get_url(url, urgent)
+        return await self.loop.run_in_executor(self.urgent_executor if urgent else self.executor, self.fs.get_url, url, urgent)
+
+    # add individuals to the family tree, downloading the persons.json batches concurrently, up to max_batches at a time
     def add_indis(self, fids):
-        async def add_datas(loop, data):
-            futures = set()
-            for person in data['persons']:
-                self.indi[person['id']] = Indi(person['id'], self)
-                futures.add(loop.run_in_executor(None, self.indi[person['id']].add_data, person))
-            for future in futures:
-                await future
-
-        new_fids = [fid for fid in fids if fid and fid not in self.indi]
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        # loop = asyncio.get_event_loop()
-        while len(new_fids):
-            data = self.fs.get_url('/platform/tree/persons.json?pids=' + ','.join(new_fids[:MAX_PERSONS]))
+        async def add(fids):
+            details = list()
+
+            async def add_batch(batch):
+                for data in await self.get_persons(batch):
+                    # merged in the event loop thread, without awaiting, hence never interleaved with another batch
+                    details.extend(asyncio.ensure_future(coroutine) for coroutine in self.new_persons(data))
+
+            await asyncio.gather(*(add_batch(fids[i:i + MAX_PERSONS]) for i in range(0, len(fids), MAX_PERSONS)))
+            await asyncio.gather(*details)
+
+        self.reached.update(fid for fid in fids if fid)
+        new_fids = [fid for fid in fids if fid and (fid not in self.indi or fid in self.seeded)]
+        if new_fids:
+            self.run(add(new_fids))
+
+    # create the individuals of a persons.json structure, with their places and relationships: returns the coroutines downloading their details
+    def new_persons(self, data):
+        if 'places' in data:
+            for place in data['places']:
+                if place['id'] not in self.places:
+                    self.places[place['id']] = (str(place['latitude']), str(place['longitude']))
+        coroutines = list()
+        for person in data['persons']:
+            if person['id'] in self.seeded:
+                # already in a previous export: only its relationships are new
+                self.seeded.discard(person['id'])
+                continue
+            self.indi[person['id']] = Indi(person['id'], self)
+            self.details[person['id']] = person
+            coroutines.append(self.indi[person['id']].add_data(person))
+        for phase in self.prefetch:
+            self.queue_details(phase, [person['id'] for person in data['persons']])
+        if 'childAndParentsRelationships' in data:
+            for rel in data['childAndParentsRelationships']:
+                father = rel['father']['resourceId'] if 'father' in rel else None
+                mother = rel['mother']['resourceId'] if 'mother' in rel else None
+                child = rel['child']['resourceId'] if 'child' in rel else None
+                if child in self.indi:
+                    self.indi[child].parents.add((father, mother))
+                if father in self.indi:
+                    self.indi[father].children.add((father, mother, child))
+                if mother in self.indi:
+                    self.indi[mother].children.add((father, mother, child))
+        if 'relationships' in data:
+            for rel in data['relationships']:
+                if rel['type'] == u'http://gedcomx.org/Couple':
+                    person1 = rel['person1']['resourceId']
+                    person2 = rel['person2']['resourceId']
+                    relfid = rel['id']
+                    if person1 in self.indi:
+                        self.indi[person1].spouses.add((person1, person2, relfid))
+                    if person2 in self.indi:
+                        self.indi[person2].spouses.add((person1, person2, relfid))
+        return coroutines
+
+    # Source objects of source description IDs, downloading those that are not in the tree yet, up to MAX_SOURCES at a time:
+    # a single missing description is downloaded alone, several ones with the sources.json (url) of the individual or couple citing them
+    async def get_sources(self, fids, url=None):
+        missing = [fid for fid in fids if fid not in self.sources and fid not in self.source_downloads]
+        if url and len(missing) > 1:
+            download = asyncio.ensure_future(self.download_sources(url, set(missing)))
+            for fid in missing:
+                self.source_downloads[fid] = download
+        else:
+            for fid in missing:
+                self.source_downloads[fid] = asyncio.ensure_future(self.download_source(fid))
+        await asyncio.gather(*{self.source_downloads[fid] for fid in fids if fid in self.source_downloads})
+        return {fid: self.sources[fid] for fid in fids if fid in self.sources}
+
+    async def download_source(self, fid):
+        data = await self.get_source_url('/platform/sources/descriptions/%s.json' % fid)
+        if data and data.get('sourceDescriptions'):
+            self.sources[fid] = Source(data['sourceDescriptions'][0], self)
+
+    async def download_sources(self, url, fids):
+        data = await self.get_source_url(url)
+        if data:
+            for source in data.get('sourceDescriptions', []):
+                if source['id'] in fids and source['id'] not in self.sources:
+                    self.sources[source['id']] = Source(source, self)
+
+    async def get_source_url(self, url):
+        if not self.source_slots:
+            # bound to the tree event loop, hence created on first use
+            self.source_slots = asyncio.Semaphore(MAX_SOURCES)
+        async with self.source_slots:
+            return await self.get_url(url)
+
+    # persons.json structures of a batch of IDs, looked up in the person cache first
+    async def get_persons(self, fids):
+        if not self.batches:
+            # bound to the tree event loop, hence created on first use
+            self.batches = asyncio.Semaphore(self.max_batches)
+        async with self.batches:
+            return await self.download_persons(fids)
+
+    async def download_persons(self, fids):
+        res = list()
+        if self.persons:
+            data = self.persons.get(fids)
+            if data['persons']:
+                res.append(data)
+            found = {person['id'] for person in data['persons']}
+            fids = [fid for fid in fids if fid not in found]
+        if fids:
+            data = await self.get_url('/platform/tree/persons.json?pids=' + ','.join(fids), True)
+            if data:
+                if self.persons:
+                    self.persons.put(data)
+                res.append(data)
+            else:
+                self.fs.write_log('WARNING: individuals not downloaded: ' + ', '.join(fids))
+        return res
+
+    # download ascend generations of ancestors and descend generations of descendants of individuals already in the tree:
+    # every new parent or child ID goes to a frontier, drained into persons.json batches when a batch is full or after linger seconds,
+    # so that a branch never waits for the end of a generation of the other branches;
+    # with bulk, the IDs of several generations are discovered at once with the ancestry and descendancy endpoints;
+    # the frontier is a priority queue ordered by generations from the starting individuals, then ancestors first, descendants
+    # and the other parents of their children last, so that the closest relatives are complete when the budget is used up
+    def crawl(self, fids, ascend, descend, linger=LINGER, bulk=False):
+        budgets = dict()  # generations left to ascend and to descend from each individual
+        frontier = list()  # heap of (distance, rank, ID), with stale entries
+        waiting = dict()  # (distance, rank) of the IDs in the frontier
+        requested = set()
+        fetching = [0]  # IDs of the persons.json batches in flight
+        tasks = dict()
+        details = list()
+        ascended = set()
+        descended = set()
+        discovered = self.discovered
+        pending = set()
+
+        def launch(coroutine, callback):
+            tasks[asyncio.ensure_future(coroutine)] = callback
+
+        def visit(fid, up, down, distance, rank):
+            if not fid:
+                return
+            self.reached.add(fid)
+            if distance < self.distance.get(fid, distance + 1):
+                self.distance[fid] = distance
+                if fid in waiting:
+                    enqueue(fid, rank)
+            if fid in budgets:
+                old_up, old_down = budgets[fid]
+                if old_up >= up and old_down >= down:
+                    return
+                up, down = max(up, old_up), max(down, old_down)
+            budgets[fid] = (up, down)
+            if bulk:
+                discover(fid)
+            if fid in self.indi:
+                expand(fid)
+            else:
+                self.frontier[fid] = (up, down)
+                if fid not in requested and fid not in waiting:
+                    enqueue(fid, rank)
+
+        def enqueue(fid, rank):
+            waiting[fid] = (self.distance[fid], rank)
+            heapq.heappush(frontier, (self.distance[fid], rank, fid))
+
+        # the IDs of the next persons.json batch, closest first
+        def dequeue(size):
+            batch = list()
+            while frontier and len(batch) < size:
+                distance, rank, fid = heapq.heappop(frontier)
+                if waiting.get(fid) == (distance, rank):
+                    del waiting[fid]
+                    requested.add(fid)
+                    batch.append(fid)
+            return batch
+
+        # only the ID is needed, so the request is sent before the person is downloaded
+        def discover(fid):
+            for kind, budget in (('ancestry', budgets[fid][0]), ('descendancy', budgets[fid][1])):
+                generations = min(budget, BULK_GENERATIONS[kind])
+                if generations > 1 and discovered[kind].get(fid, 0) < generations and (kind, fid) not in pending and not self.budget.exceeded(self):
+                    pending.add((kind, fid))
+                    url = '/platform/tree/%s?person=%s&generations=%s' % (kind, fid, generations)
+                    launch(self.get_url(url, True), lambda data, kind=kind, fid=fid, generations=generations: add_pedigree(kind, fid, generations, data))
+
+        def add_pedigree(kind, fid, generations, data):
+            pending.discard((kind, fid))
             if data:
-                if 'places' in data:
-                    for place in data['places']:
-                        if place['id'] not in self.places:
-                            self.places[place['id']] = (str(place['latitude']), str(place['longitude']))
-                loop.run_until_complete(add_datas(loop, data))
-                if 'childAndParentsRelationships' in data:
-                    for rel in data['childAndParentsRelationships']:
-                        father = rel['father']['resourceId'] if 'father' in rel else None
-                        mother = rel['mother']['resourceId'] if 'mother' in rel else None
-                        child = rel['child']['resourceId'] if 'child' in rel else None
-                        if child in self.indi:
-                            self.indi[child].parents.add((father, mother))
-                        if father in self.indi:
-                            self.indi[father].children.add((father, mother, child))
-                        if mother in self.indi:
-                            self.indi[mother].children.add((father, mother, child))
-                if 'relationships' in data:
-                    for rel in data['relationships']:
-                        if rel['type'] == u'http://gedcomx.org/Couple':
-                            person1 = rel['person1']['resourceId']
-                            person2 = rel['person2']['resourceId']
-                            relfid = rel['id']
-                            if person1 in self.indi:
-                                self.indi[person1].spouses.add((person1, person2, relfid))
-                            if person2 in self.indi:
-                                self.indi[person2].spouses.add((person1, person2, relfid))
-            new_fids = new_fids[MAX_PERSONS:]
+                # recorded once downloaded, so that the requests in flight are sent again when a checkpoint is resumed
+                discovered[kind][fid] = max(discovered[kind].get(fid, 0), generations)
+            up, down = budgets[fid]
+            distance = self.distance[fid]
+            for person in data['persons'] if data else []:
+                number = person.get('display', {}).get('ascendancyNumber' if kind == 'ancestry' else 'descendancyNumber', '')
+                if kind == 'ancestry' and number.isdigit():
+                    # ahnentafel number: 1 for the individual, 2 and 3 for the parents, 4 to 7 for the grandparents...
+                    generation = int(number).bit_length() - 1
+                    if generation:
+                        discovered[kind][person['id']] = max(discovered[kind].get(person['id'], 0), generations - generation)
+                        visit(person['id'], up - generation, descend, distance + generation, 0)
+                elif kind == 'descendancy' and number:
+                    # 1 for the individual, 1-S for a spouse, 1.1 for a child, 1.1.1 for a grandchild...
+                    # spouses are left to the parents of the children, as without bulk
+                    generation = number.count('.')
+                    if '-S' not in number and generation:
+                        discovered[kind][person['id']] = max(discovered[kind].get(person['id'], 0), generations - generation)
+                        visit(person['id'], 0, down - generation, distance + generation, 1)
+            if fid in self.indi:
+                expand(fid)
+
+        def expand(fid):
+            up, down = budgets[fid]
+            distance = self.distance[fid]
+            if fid in self.seeded and (down > 0 or up > 0 and not self.indi[fid].parents):
+                # the previous export may stop here: its relationships are downloaded first
+                self.frontier[fid] = (up, down)
+                if fid not in requested and fid not in waiting:
+                    enqueue(fid, 0)
+                return
+            if up > 0:
+                ascended.add(fid)
+                if ('ancestry', fid) not in pending:
+                    for couple in self.indi[fid].parents:
+                        for parent in couple:
+                            visit(parent, up - 1, descend, distance + 1, 0)
+            if down > 0:
+                descended.add(fid)
+                if ('descendancy', fid) not in pending:
+                    for father, mother, child in self.indi[fid].children:
+                        visit(child, 0, down - 1, distance + 1, 1)
+                        visit(father, 0, 0, distance + 1, 2)
+                        visit(mother, 0, 0, distance + 1, 2)
+
+        def add_batch(size, datas):
+            fetching[0] -= size
+            for data in datas:
+                details.extend(asyncio.ensure_future(coroutine) for coroutine in self.new_persons(data))
+                for person in data['persons']:
+                    self.frontier.pop(person['id'], None)
+                    if person['id'] in budgets:
+                        expand(person['id'])
+
+        # size of the next persons.json batch allowed by the budget
+        def batch_size():
+            if self.budget.exceeded(self):
+                return 0
+            return max(0, min(MAX_PERSONS, self.budget.persons_left(self) - fetching[0]))
+
+        async def explore():
+            for fid in fids:
+                visit(fid, ascend, descend, 0, 0)
+            # IDs left in the frontier by an interrupted run
+            for fid, (up, down) in list(self.frontier.items()):
+                visit(fid, up, down, self.distance.get(fid, 0), 0)
+            since = self.loop.time()
+            while waiting or tasks:
+                size = batch_size()
+                while size and (len(waiting) >= size or waiting and (not tasks or self.loop.time() - since >= linger)):
+                    batch = dequeue(size)
+                    fetching[0] += len(batch)
+                    launch(self.get_persons(batch), lambda datas, size=len(batch): add_batch(size, datas))
+                    since = self.loop.time()
+                    size = batch_size()
+                if not tasks:
+                    # the budget is used up
+                    break
+                timeout = max(0, linger - (self.loop.time() - since)) if waiting and size else None
+                done, running = await asyncio.wait(list(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    was_empty = not waiting
+                    tasks.pop(task)(task.result())
+                    if was_empty and waiting:
+                        since = self.loop.time()
+            await asyncio.gather(*details)
+            self.unexplored |= waiting.keys() - self.indi.keys()
+            # IDs that could not be downloaded
+            self.frontier.clear()
+
+        self.run(explore())
+        for fid in ascended:
+            for father, mother in self.indi[fid].parents:
+                if mother in self.indi and father in self.indi or not father and mother in self.indi or not mother and father in self.indi:
+                    self.add_trio(father, mother, fid)
+        for fid in descended:
+            for father, mother, child in self.indi[fid].children:
+                if child in self.indi and (mother in self.indi and father in self.indi or not father and mother in self.indi or not mother and father in self.indi):
+                    self.add_trio(father, mother, child)
 
     # add family to the family tree
     def add_fam(self, father, mother):
@@ -810,26 +2176,36 @@ class Tree:
 
     # add spouse relationships
     def add_spouses(self, fids):
-        async def add(loop, rels):
-            futures = set()
+        async def add(rels):
+            coroutines = list()
             for father, mother, relfid in rels:
-                if (father, mother) in self.fam:
-                    futures.add(loop.run_in_executor(None, self.fam[(father, mother)].add_marriage, relfid))
-            for future in futures:
-                await future
+                if (father, mother) in self.fam and not self.finished('marriage', (father, mother)):
+                    coroutines.append(self.fam[(father, mother)].add_marriage(relfid))
+            await asyncio.gather(*coroutines)
 
+        # spouses of the individuals of a previous export are not all in it
+        self.add_indis(fids & self.seeded)
         rels = set()
         for fid in (fids & self.indi.keys()):
             rels |= self.indi[fid].spouses
-        loop = asyncio.get_event_loop()
         if rels:
-            self.add_indis(set.union(*({father, mother} for father, mother, relfid in rels)))
+            # spouses of the closest relatives first, as many as the budget allows
+            distance = dict()
+            for father, mother, relfid in rels:
+                for spouse, other in ((father, mother), (mother, father)):
+                    if spouse not in self.indi:
+                        distance[spouse] = min(distance.get(spouse, float('inf')), self.distance.get(other, float('inf')))
+            spouses = sorted(distance, key=distance.get)
+            left = 0 if self.budget.exceeded(self) else min(len(spouses), self.budget.persons_left(self))
+            self.unexplored.update(spouses[left:])
+            self.add_indis(list(set.union(*({father, mother} for father, mother, relfid in rels)) - distance.keys()) + spouses[:left])
             for father, mother, relfid in rels:
                 if father in self.indi and mother in self.indi:
                     self.indi[father].add_fams((father, mother))
                     self.indi[mother].add_fams((father, mother))
                     self.add_fam(father, mother)
-            loop.run_until_complete(add(loop, rels))
+            if not self.budget.exhausted(self):
+                self.run(add(rels))
 
     # add children relationships
     def add_children(self, fids):
@@ -845,10 +2221,14 @@ class Tree:
                     children.add(child)
         return children
 
-    # retrieve ordinances
-    def add_ordinances(self, fid):
+    # retrieve ordinances: their families are linked by link_ordinances once the families exist
+    async def add_ordinances(self, fid):
+        if fid in self.indi:
+            self.sealings[fid] = await self.indi[fid].get_ordinances()
+
+    def link_ordinances(self, fid):
+        ret, famc = self.sealings.pop(fid)
         if fid in self.indi:
-            ret, famc = self.indi[fid].get_ordinances()
             if famc and famc in self.fam:
                 self.indi[fid].sealing_child.famc = self.fam[famc]
             for o in ret:
@@ -858,6 +2238,100 @@ class Tree:
                 elif (o['spouse']['resourceId'], fid) in self.fam:
                     self.fam[(o['spouse']['resourceId'], fid)
                              ].sealing_spouse = Ordinance(o)
+            self.finish('ordinances', fid)
+
+    # download the ordinances, notes and contributors of the individuals as soon as they are created and those of the
+    # couples as soon as their marriage is, alongside the crawl, rather than all of them in download_stuff
+    def prefetch_details(self, ordinances=False, contributors=False, workers=None):
+        self.detail_limits = dict(DETAIL_WORKERS, **(workers or dict()))
+        if self.budget.requests is not None or self.budget.seconds is not None:
+            # the requests and the time of a budget go to the closest individuals first, then to their details
+            return
+        self.prefetch = [phase for phase, wanted in (('ordinances', ordinances), ('notes', True), ('contributors', contributors)) if wanted]
+
+    # queue the downloads of a phase for keys of individuals (IDs) or families (couples): they are run by at most
+    # detail_limits[phase] workers per phase, and a free worker takes the first phase of DETAIL_WORKERS with a free slot,
+    # so that ordinances, which link families, come first and contributors last
+    def queue_details(self, phase, keys):
+        self.detail_queues.setdefault(phase, collections.deque()).append(iter(keys))
+        for i in range(sum(self.detail_limits.values()) - len(self.detail_workers)):
+            task = self.loop.create_task(self.detail_worker())
+            self.detail_workers.add(task)
+            task.add_done_callback(self.detail_done)
+
+    # next key of a phase that is neither downloaded nor downloading
+    def next_detail(self, phase):
+        queue = self.detail_queues.get(phase)
+        while queue:
+            key = next(queue[0], None)
+            if key is None:
+                queue.popleft()
+            elif not self.finished(phase, key) and (phase, key) not in self.detail_keys and not (phase == 'ordinances' and key in self.sealings) and (key in self.fam if isinstance(key, tuple) else key in self.indi):
+                return key
+        return None
+
+    async def detail_worker(self):
+        while not self.budget.exhausted(self):
+            for phase in DETAIL_WORKERS:
+                key = self.next_detail(phase) if self.detail_running[phase] < self.detail_limits[phase] else None
+                if key is not None:
+                    break
+            else:
+                # the phases left are downloaded by as many workers as they allow
+                return
+            self.detail_running[phase] += 1
+            self.detail_keys.add((phase, key))
+            try:
+                if phase == 'ordinances':
+                    await self.add_ordinances(key)
+                elif phase == 'notes':
+                    await (self.fam[key] if isinstance(key, tuple) else self.indi[key]).get_notes()
+                else:
+                    await (self.fam[key] if isinstance(key, tuple) else self.indi[key]).get_contributors()
+            finally:
+                self.detail_running[phase] -= 1
+                self.detail_keys.discard((phase, key))
+
+    # a failed worker is kept, so that download_stuff raises its error
+    def detail_done(self, task):
+        if task.cancelled() or not task.exception():
+            self.detail_workers.discard(task)
+        elif self.fs:
+            self.fs.write_log('Download of ordinances, notes or contributors failed: %r' % task.exception())
+
+    # download the ordinances, notes and contributors not downloaded yet, wait for those downloading and link the
+    # ordinances to their families; the first error stops the downloads instead of being raised once they are over
+    def download_stuff(self, ordinances=False, contributors=False, workers=None):
+        async def download():
+            if not self.budget.exhausted(self):
+                fids, keys = list(self.indi), list(self.indi) + list(self.fam)
+                if ordinances:
+                    self.queue_details('ordinances', fids)
+                self.queue_details('notes', keys)
+                if contributors:
+                    self.queue_details('contributors', keys)
+            try:
+                while self.detail_workers:
+                    await asyncio.gather(*self.detail_workers)
+            except Exception:
+                for task in self.detail_workers:
+                    task.cancel()
+                await asyncio.gather(*self.detail_workers, return_exceptions=True)
+                raise
+
+        if workers:
+            self.detail_limits = dict(DETAIL_WORKERS, **workers)
+        self.run(download())
+        for fid in list(self.sealings):
+            self.link_ordinances(fid)
+
+    # release the connections of the asynchronous session, the download threads and the event loop
+    def close(self):
+        if self.afs:
+            self.run(self.afs.close())
+        self.executor.shutdown(wait=False)
+        self.urgent_executor.shutdown(wait=False)
+        self.loop.close()
 
     def reset_num(self):
         for husb, wife in self.fam:
@@ -901,6 +2375,14 @@ class Tree:
         file.write('0 TRLR\n')
 
 
+# parse a PHASE=WORKERS option
+def workers_option(value):
+    phase, workers = value.split('=')
+    if phase not in DETAIL_WORKERS or int(workers) < 1:
+        raise ValueError(value)
+    return phase, int(workers)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Retrieve GEDCOM data from FamilySearch Tree (4 Jul 2016)', add_help=False, usage='getmyancestors.py -u username -p password [options]')
     parser.add_argument('-u', metavar='<STR>', type=str, help='FamilySearch username')
@@ -913,6 +2395,32 @@ if __name__ == '__main__':
     parser.add_argument('-c', action="store_true", default=False, help='Add LDS ordinances (need LDS account) [False]')
     parser.add_argument("-v", action="store_true", default=False, help="Increase output verbosity [False]")
     parser.add_argument('-t', metavar='<INT>', type=int, default=60, help='Timeout in seconds [60]')
+    parser.add_argument('--pool-connections', metavar='<INT>', type=int, default=POOL_CONNECTIONS, help='Number of hosts to keep a connection pool for [%s]' % POOL_CONNECTIONS)
+    parser.add_argument('--pool-maxsize', metavar='<INT>', type=int, default=POOL_MAXSIZE, help='Number of keep-alive connections per host and of download threads [%s]' % POOL_MAXSIZE)
+    parser.add_argument('--max-rate', metavar='<FLOAT>', type=float, default=MAX_RATE, help='Maximum number of requests per second, the actual rate adapts to the server [no limit]')
+    parser.add_argument('--max-attempts', metavar='<INT>', type=int, default=MAX_ATTEMPTS, help='Maximum number of attempts per URL [%s]' % MAX_ATTEMPTS)
+    parser.add_argument('--cache', action="store_true", default=False, help='Keep downloaded data in a persistent cache, revalidated after --cache-ttl [False]')
+    parser.add_argument('--cache-dir', metavar='<DIR>', type=str, help='Cache directory [~/.cache/getmyancestors]')
+    parser.add_argument('--cache-ttl', metavar='<INT>', type=int, default=CACHE_TTL, help='Seconds during which cached data is used without revalidation [%s]' % CACHE_TTL)
+    parser.add_argument('--cache-size', metavar='<INT>', type=int, default=CACHE_SIZE, help='Maximum size of the cache in megabytes [%s]' % CACHE_SIZE)
+    parser.add_argument('--person-ttl', metavar='<INT>', type=int, default=CACHE_TTL, help='Seconds during which cached persons are used without downloading them again [%s]' % CACHE_TTL)
+    parser.add_argument('--offline', action="store_true", default=False, help='Only use the cache, without connecting to FamilySearch [False]')
+    parser.add_argument('--keep-session', action="store_true", default=False, help='Keep the FamilySearch session in the cache directory and reuse it in the next runs [False]')
+    parser.add_argument('--bulk', action="store_true", default=False, help='Discover up to %s generations of ancestors and %s of descendants per request with the ancestry and descendancy endpoints [False]' % (BULK_GENERATIONS['ancestry'], BULK_GENERATIONS['descendancy']))
+    parser.add_argument('--max-batches', metavar='<INT>', type=int, default=MAX_BATCHES, help='Maximum number of concurrent requests of %s persons [%s]' % (MAX_PERSONS, MAX_BATCHES))
+    parser.add_argument('--max-in-flight', metavar='<INT>', type=int, default=MAX_IN_FLIGHT, help='Maximum number of concurrent requests when aiohttp is installed [%s]' % MAX_IN_FLIGHT)
+    parser.add_argument('--detail-workers', metavar='<PHASE=INT>', type=workers_option, action='append', default=[], help='Number of concurrent downloads of a phase of ordinances, notes and contributors, e.g. notes=32 (repeatable) [%s]' % ' '.join('%s=%s' % item for item in DETAIL_WORKERS.items()))
+    parser.add_argument('--max-persons', metavar='<INT>', type=int, help='Stop downloading new individuals beyond this number, the closest relatives first [no limit]')
+    parser.add_argument('--max-requests', metavar='<INT>', type=int, help='Stop starting new downloads beyond this number of HTTP requests, the closest relatives first [no limit]')
+    parser.add_argument('--max-time', metavar='<INT>', type=int, help='Stop starting new downloads after this number of seconds, the closest relatives first [no limit]')
+    parser.add_argument('--jobs', metavar='<FILE>', type=argparse.FileType('r', encoding='UTF-8'), help='Run the jobs of this JSON file with one session and one tree, writing one GEDCOM file per job: a list of {"i": [IDs], "o": "file.ged"} with optional "a", "d" and "m"')
+    parser.add_argument('--checkpoint', metavar='<FILE>', type=str, help='Save the state of the download to this file periodically, so that an interrupted download can be resumed with --resume')
+    parser.add_argument('--checkpoint-interval', metavar='<INT>', type=int, default=CHECKPOINT_INTERVAL, help='Seconds between two checkpoints [%s]' % CHECKPOINT_INTERVAL)
+    parser.add_argument('--resume', action="store_true", default=False, help='Resume the download saved in the --checkpoint file, without downloading again what was completed [False]')
+    parser.add_argument('--extend', metavar='<FILE>', type=argparse.FileType('r', encoding='UTF-8'), help='Extend a previous GEDCOM export of getmyancestors.py: its individuals are not downloaded again, only those beyond it')
+    parser.add_argument('--refresh', metavar='<FILE>', type=str, help='Keep the downloaded tree in this file, so that the next runs only download again the individuals and couples changed since then')
+    parser.add_argument('--metrics', metavar='<FILE>', type=str, help='Write per-endpoint HTTP metrics to this file at the end and on SIGUSR1, in Prometheus format if it ends with .prom and in JSON otherwise')
+    parser.add_argument('--base-url', metavar='<URL>', type=str, help='Base URL of the FamilySearch API, e.g. a local fsstandin.py server [https://familysearch.org]')
     parser.add_argument('--show-password', action="store_true", default=False, help="Show password in .settings file [False]")
     try:
         parser.add_argument('-o', metavar='<FILE>', type=argparse.FileType('w', encoding='UTF-8'), default=sys.stdout, help='output GEDCOM file [stdout]')
@@ -930,13 +2438,30 @@ if __name__ == '__main__':
         parser.print_help()
         exit(2)
 
+    if args.resume and not args.checkpoint:
+        exit('--resume requires a --checkpoint file')
+
+    # batch jobs: starting individuals and GEDCOM file of each job, with -a, -d and -m as defaults
+    jobs = list()
+    if args.jobs:
+        if args.checkpoint or args.refresh or args.extend:
+            exit('--jobs cannot be used with --checkpoint, --refresh or --extend')
+        for job in json.load(args.jobs):
+            if not job.get('i') or not job.get('o'):
+                exit('Each job needs a list of FamilySearch IDs "i" and a GEDCOM file "o": ' + json.dumps(job))
+            jobs.append({'i': [job['i']] if isinstance(job['i'], str) else job['i'], 'o': job['o'], 'a': job.get('a', args.a), 'd': job.get('d', args.d), 'm': job.get('m', args.m)})
+        args.i = [fid for job in jobs for fid in job['i']]
+
     if args.i:
         for fid in args.i:
             if not re.match(r'[A-Z0-9]{4}-[A-Z0-9]{3}', fid):
                 exit('Invalid FamilySearch ID: ' + fid)
 
-    username = args.u if args.u else input("Enter FamilySearch username: ")
-    password = args.p if args.p else getpass.getpass("Enter FamilySearch password: ")
+    if args.offline:
+        username, password = args.u or '', args.p or ''
+    else:
+        username = args.u if args.u else input("Enter FamilySearch username: ")
+        password = args.p if args.p else getpass.getpass("Enter FamilySearch password: ")
 
     time_count = time.time()
 
@@ -971,69 +2496,97 @@ if __name__ == '__main__':
                 settings_record.write(settings_output)
 
     # initialize a FamilySearch session and a family tree object
+    cache = ResponseCache(args.cache_dir, args.cache_ttl, args.cache_size) if args.cache or args.offline else None
     print('Login to FamilySearch...')
-    fs = Session(username, password, args.v, args.l, args.t)
+    fs = Session(username, password, args.v, args.l, args.t, args.pool_connections, args.pool_maxsize, args.max_rate, RetryPolicy(cap=args.t, max_attempts=args.max_attempts), cache, args.offline, os.path.join(cache_dir(args.cache_dir), 'session') if args.keep_session else None, args.base_url)
     if not fs.logged:
         exit(2)
+    if args.offline:
+        # the user, and so the language and the name in the GEDCOM header, can only come from the cache
+        fs.set_current()
+        if not fs.lang or not fs.display_name:
+            exit('--offline needs the current user in the cache: run once with --cache first')
+    if args.metrics and hasattr(signal, 'SIGUSR1'):
+        # the signal may interrupt the main thread while it records a request, holding the lock of the metrics
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=fs.metrics.dump, args=(args.metrics,), daemon=True).start())
     _ = fs._
-    tree = Tree(fs)
+    tree = Tree(fs, AsyncSession(fs, args.max_in_flight) if aiohttp else None, PersonCache(args.cache_dir, args.person_ttl) if cache else None, args.max_batches, args.checkpoint, args.checkpoint_interval, Budget(args.max_persons, args.max_requests, args.max_time))
 
     # check LDS account
     if args.c and fs.get_url('/platform/tree/persons/%s/ordinances.json' % fs.get_userid()) == 'error':
         exit(2)
+    # the details are downloaded alongside the crawl
+    tree.prefetch_details(args.c, args.r, dict(args.detail_workers))
 
     # add list of starting individuals to the family tree
     todo = args.i if args.i else [fs.get_userid()]
-    print(_('Downloading starting individuals...'))
-    tree.add_indis(todo)
-
-    # download ancestors
-    todo = set(todo)
-    done = set()
-    for i in range(args.a):
-        if not todo:
-            break
-        done |= todo
-        print(_('Downloading %s. of generations of ancestors...') % (i + 1))
-        todo = tree.add_parents(todo) - done
-
-    # download descendants
-    todo = set(tree.indi.keys())
-    done = set()
-    for i in range(args.d):
-        if not todo:
-            break
-        done |= todo
-        print(_('Downloading %s. of generations of descendants...') % (i + 1))
-        todo = tree.add_children(todo) - done
-
-    # download spouses
-    if args.m:
-        print(_('Downloading spouses and marriage information...'))
-        todo = set(tree.indi.keys())
-        tree.add_spouses(todo)
+    restored = False
+    if args.resume:
+        print(_('Resuming the download saved in %s...') % args.checkpoint)
+        restored = tree.restore()
+        if not restored:
+            print(_('No checkpoint to resume, starting a new download...'))
+    if args.refresh and not restored and os.path.exists(args.refresh):
+        print(_('Looking for changes since the download saved in %s...') % args.refresh)
+        restored = tree.restore(args.refresh)
+        if restored:
+            print(_('%s individuals and %s couples changed.') % tree.refresh())
+    if args.extend and not restored:
+        print(_('Reading %s...') % args.extend.name)
+        print(_('%s individuals and %s families already downloaded.') % tree.load_gedcom(args.extend))
+    if jobs:
+        # the jobs share the tree, so that the individuals of several jobs are downloaded once
+        for number, job in enumerate(jobs, 1):
+            print(_('Job %s of %s: downloading %s generations of ancestors and %s of descendants of %s...') % (number, len(jobs), job['a'], job['d'], ', '.join(job['i'])))
+            tree.reached = set()
+            tree.distance = dict()
+            tree.add_indis(job['i'])
+            tree.crawl(job['i'], job['a'], job['d'], bulk=args.bulk)
+            if job['m']:
+                tree.add_spouses(tree.reached & tree.indi.keys())
+            job['fids'] = tree.reached & tree.indi.keys()
+    else:
+        print(_('Downloading starting individuals...'))
+        tree.add_indis(todo)
+
+        # download ancestors and descendants
+        if args.a:
+            print(_('Downloading %s generations of ancestors...') % args.a)
+        if args.d:
+            print(_('Downloading %s generations of descendants...') % args.d)
+        tree.crawl(todo, args.a, args.d, bulk=args.bulk)
+
+        # download spouses
+        if args.m:
+            print(_('Downloading spouses and marriage information...'))
+            todo = set(tree.indi.keys())
+            tree.add_spouses(todo)
 
     # download ordinances, notes and contributors
-    async def download_stuff(loop):
-        futures = set()
-        for fid, indi in tree.indi.items():
-            futures.add(loop.run_in_executor(None, indi.get_notes))
-            if args.c:
-                futures.add(loop.run_in_executor(None, tree.add_ordinances, fid))
-            if args.r:
-                futures.add(loop.run_in_executor(None, indi.get_contributors))
-        for fam in tree.fam.values():
-            futures.add(loop.run_in_executor(None, fam.get_notes))
-            if args.r:
-                futures.add(loop.run_in_executor(None, fam.get_contributors))
-        for future in futures:
-            await future
-
-    loop = asyncio.get_event_loop()
     print(_('Downloading notes') + (((',' if args.r else _(' and')) + _(' ordinances')) if args.c else '') + (_(' and contributors') if args.r else '') + '...')
-    loop.run_until_complete(download_stuff(loop))
+    tree.download_stuff(args.c, args.r)
+    tree.close()
+
+    # keep the tree for the next refresh
+    if args.refresh:
+        tree.prune()
+        tree.save(args.refresh)
 
     # compute number for family relationships and print GEDCOM file
-    tree.reset_num()
-    tree.print(args.o)
+    for job in jobs:
+        selected = tree.select(job['fids'], job['m'])
+        selected.reset_num()
+        with open(job['o'], 'w', encoding='UTF-8') as file:
+            selected.print(file)
+        print(_('%s: %s individuals and %s families.') % (job['o'], str(len(selected.indi)), str(len(selected.fam))))
+    if not jobs:
+        tree.reset_num()
+        tree.print(args.o)
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
     print(_('Downloaded %s individuals, %s families, %s sources and %s notes in %s seconds with %s HTTP requests.') % (str(len(tree.indi)), str(len(tree.fam)), str(len(tree.sources)), str(len(tree.notes)), str(round(time.time() - time_count)), str(fs.counter)))
+    print(_('%s retries, %s failed requests, %s circuit breaker trips and %s coalesced requests.') % (str(fs.retries), str(fs.failures), str(fs.trips), str(fs.coalesced)))
+    if tree.budget.reason:
+        print(_('Budget --max-%s used up: %s individuals of the frontier left unexplored.') % (tree.budget.reason, str(len(tree.unexplored - tree.indi.keys()))))
+    if args.metrics:
+        fs.metrics.dump(args.metrics)
@@ -62,6 +62,9 @@ class Gedcom:
 
     def __parse(self):
         while self.__get_line():
+            # only records, not the lines of the header such as 1 SOUR getmyancestors
+            if not self.pointer:
+                continue
             if self.tag == 'INDI':
                 self.num = int(self.pointer[2:len(self.pointer) - 1])
                 self.indi[self.num] = Indi(tree=self.tree, num=self.num)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+   stresstest.py - Check that the individuals, families, notes and sources built
+   by concurrent threads never share a number in a tree
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# global import
+from __future__ import print_function
+import io
+import re
+import sys
+import time
+import argparse
+import threading
+import collections
+
+# local import
+from getmyancestors import Session, AsyncSession, Tree, Indi, Fam, Note, Source, aiohttp, LINGER
+from fsstandin import Pedigree, StandInServer
+
+
+# numbers given to more than one record of a kind in a tree
+def duplicates(tree):
+    res = dict()
+    for kind, records in (('indi', tree.indi.values()), ('fam', tree.fam.values()), ('note', tree.notes), ('source', tree.sources.values())):
+        counts = collections.Counter(record.num for record in records)
+        res[kind] = sum(n - 1 for n in counts.values() if n > 1)
+    return res
+
+
+# records built by several threads at once, in a tree of their own and in a tree shared by all of them
+def build(trees, shared, records, errors):
+    def work(tree):
+        try:
+            for i in range(records):
+                for t in (tree, shared):
+                    fid = '%s-%s' % (id(tree), i)
+                    t.indi[fid] = Indi(fid, t)
+                    t.fam[fid] = Fam(None, None, t)
+                    t.sources[fid] = Source(None, t)
+                    Note('note %s' % i, t)
+                    # the same contributors of many records share one note
+                    t.registry.note('=== Contributors ===\ncontributor %s' % (i % 10), t)
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=work, args=(tree,)) for tree in trees]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# whole downloads run by several threads at once with one session, as the workers of exportserver.py:
+# returns the tree and the GEDCOM output of each
+def crawl(fs, crawls, ascend, descend, errors):
+    res = [None] * crawls
+
+    def work(number):
+        try:
+            tree = Tree(fs, AsyncSession(fs) if aiohttp else None)
+            tree.prefetch_details(False, True)
+            fids = [fs.get_userid()]
+            tree.add_indis(fids)
+            tree.crawl(fids, ascend + number % 3, descend, LINGER)
+            tree.add_spouses(set(tree.indi.keys()))
+            tree.download_stuff(False, True)
+            tree.close()
+            tree.reset_num()
+            output = io.StringIO()
+            tree.print(output)
+            res[number] = (tree, output.getvalue())
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=work, args=(number,)) for number in range(crawls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stress the numbering of the records of getmyancestors.py with concurrent threads', add_help=False, usage='stresstest.py [options]')
+    parser.add_argument('--threads', metavar='<INT>', type=int, default=16, help='Number of threads building records [16]')
+    parser.add_argument('--records', metavar='<INT>', type=int, default=5000, help='Number of records of each kind built by each thread [5000]')
+    parser.add_argument('--crawls', metavar='<INT>', type=int, default=8, help='Number of downloads run at the same time against fsstandin.py, 0 for none [8]')
+    parser.add_argument('--size', metavar='<INT>', type=int, default=1000, help='Number of persons of the synthetic tree [1000]')
+    parser.add_argument('-a', metavar='<INT>', type=int, default=4, help='Number of generations to ascend, plus 0 to 2 depending on the download [4]')
+    parser.add_argument('-d', metavar='<INT>', type=int, default=1, help='Number of generations to descend [1]')
+    parser.add_argument('--switch-interval', metavar='<FLOAT>', type=float, default=1e-6, help='Seconds between two thread switches of the interpreter, small to interleave the threads [1e-06]')
+
+    try:
+        parser.error = parser.exit
+        args = parser.parse_args()
+    except SystemExit:
+        parser.print_help()
+        exit(2)
+
+    sys.setswitchinterval(args.switch_interval)
+    errors = list()
+    failed = False
+
+    start = time.time()
+    trees = [Tree() for i in range(args.threads)]
+    shared = Tree()
+    build(trees, shared, args.records, errors)
+    found = collections.Counter()
+    for tree in trees + [shared]:
+        found.update(duplicates(tree))
+    contributors = sum(1 for note in shared.notes if note.text.startswith('=== Contributors ==='))
+    sys.stderr.write('%s threads built %s records of each kind in %.2f seconds: %s duplicate numbers, %s contributor notes in the shared tree\n'
+                     % (args.threads, args.threads * args.records * 2, time.time() - start, dict(found), contributors))
+    failed |= any(found.values()) or contributors != min(10, args.records)
+
+    if args.crawls:
+        server = StandInServer(('localhost', 0), Pedigree(args.size, args.a + 2)).start()
+        fs = Session('stresstest', 'stresstest', base_url=server.base_url)
+        start = time.time()
+        results = crawl(fs, args.crawls, args.a, args.d, errors)
+        server.shutdown()
+        server.server_close()
+        found = collections.Counter()
+        for result in results:
+            if result:
+                tree, gedcom = result
+                found.update(duplicates(tree))
+                xrefs = collections.Counter(re.findall(r'^0 (@\w+@)', gedcom, re.M))
+                found['gedcom'] += sum(n - 1 for n in xrefs.values() if n > 1)
+        sys.stderr.write('%s downloads in %.2f seconds: %s duplicate numbers\n' % (args.crawls, time.time() - start, dict(found)))
+        failed |= any(found.values()) or None in results
+
+    for error in errors:
+        sys.stderr.write('ERROR: %s\n' % error)
+    if failed or errors:
+        exit(1)
@@ -98,10 +98,37 @@ translations = {
         'ru': 'Название племени',
         'zh': '部落名字'
     },
+    'Resuming the download saved in %s...': {
+        'fr': 'Reprise du téléchargement sauvegardé dans %s...',
+    },
+    'No checkpoint to resume, starting a new download...': {
+        'fr': 'Aucune sauvegarde à reprendre, nouveau téléchargement...',
+    },
+    'Looking for changes since the download saved in %s...': {
+        'fr': 'Recherche des modifications depuis le téléchargement sauvegardé dans %s...',
+    },
+    '%s individuals and %s couples changed.': {
+        'fr': '%s personnes et %s couples modifiés.',
+    },
+    'Reading %s...': {
+        'fr': 'Lecture de %s...',
+    },
+    '%s individuals and %s families already downloaded.': {
+        'fr': '%s personnes et %s familles déjà téléchargées.',
+    },
+    'Job %s of %s: downloading %s generations of ancestors and %s of descendants of %s...': {
+        'fr': "Tâche %s sur %s : téléchargement de %s génération(s) d'ancêtres et %s de descendants de %s...",
+    },
+    '%s: %s individuals and %s families.': {
+        'fr': '%s : %s personnes et %s familles.',
+    },
+    'Budget --max-%s used up: %s individuals of the frontier left unexplored.': {
+        'fr': 'Budget --max-%s épuisé : %s personnes de la frontière restent inexplorées.',
+    },
     'Downloading starting individuals...': {
         'fr': 'Téléchargement des personnes de départ...',
     },
-    'Downloading %s. of generations of descendants...': {
+    'Downloading %s generations of descendants...': {
         'fr': 'Téléchargement de %s génération(s) de descendants...',
     },
     'Downloading spouses and marriage information...': {
@@ -122,6 +149,9 @@ translations = {
     'Downloaded %s individuals, %s families, %s sources and %s notes in %s seconds with %s HTTP requests.': {
         'fr': '%s personnes, %s familles, %s sources et %s notes téléchargés en %s secondes avec %s requêtes HTTP.',
     },
+    '%s retries, %s failed requests, %s circuit breaker trips and %s coalesced requests.': {
+        'fr': '%s nouvelles tentatives, %s requêtes échouées, %s déclenchements du disjoncteur et %s requêtes regroupées.',
+    },
     'Download ': {
         'fr': 'Téléchargement de la ',
     },
@@ -194,7 +224,7 @@ translations = {
     'Options': {
         'fr': 'Options',
     },
-    'Downloading %s. of generations of ancestors...': {
+    'Downloading %s generations of ancestors...': {
         'fr': "Téléchargement de %s génération(s) d'ancêtres...",
     },
     'Save': {